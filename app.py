@@ -5,41 +5,470 @@ import os
 import sqlite3
 import pytz
 import cloudinary
-import cloudinary.uploader
 import cloudinary.api
-import json
 import uuid
+import atexit
+import queue
+import hashlib
+import tempfile
+import time
 from dotenv import load_dotenv
-from flask import Flask, flash, redirect, render_template, request, session, g, jsonify
+from flask import Flask, flash, redirect, render_template, request, session, g, jsonify, make_response, before_render_template, template_rendered
 from flask_session import Session
-from werkzeug.security import check_password_hash, generate_password_hash
+from markupsafe import Markup
 from email_validator import validate_email, EmailNotValidError
 from datetime import datetime
 from flask_socketio import SocketIO, emit, join_room, leave_room
-
-from helpers import apology, login_required, validate_password, allowed_file, make_initial, format_message_date
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from database import ConnectionPool
+from writer import MessageWriter
+from mq import Bus, create_client_manager
+from cache import TTLCache, SizedCache
+from search import search_messages, search_channels
+from directory import ChannelDirectory
+from assets import StaticVersions, Compressor
+from sessions import SQLiteSessionInterface
+from connections import Connections
+from wire import NewMessage, NewMember, WireJSON
+from coalesce import Coalescer
+from uploads import UploadPipeline, LocalStorage, CloudinaryStorage, can_resize
+from metrics import registry, TimedConnection, log_slow_queries
+from passwords import PasswordHasher, HasherBusy, RateLimiter
+from recent import RecentMessages
+from outbound import OutboundQueues
+from helpers import apology, login_required, metrics_access_required, validate_password, allowed_file, make_initial, format_messages, local_now, local_date, conditional_json, messages_modified_at
 
 load_dotenv()
 
 # Configure application
 app = Flask(__name__)
-socketio = SocketIO(app, async_mode="eventlet")
 
 app.config["DATABASE"] = os.getenv("DATABASE")
 app.config["TIMEZONE"] = os.getenv("TIMEZONE")
-
-# Configure session to use filesystem (instead of signed cookies)
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
+app.config["DATABASE_POOL_SIZE"] = int(os.getenv("DATABASE_POOL_SIZE", 10))
+app.config["DATABASE_POOL_TIMEOUT"] = float(os.getenv("DATABASE_POOL_TIMEOUT", 30))
+app.config["MESSAGE_WRITE_BEHIND"] = os.getenv("MESSAGE_WRITE_BEHIND", "false").lower() == "true"
+app.config["MESSAGE_FLUSH_INTERVAL"] = int(os.getenv("MESSAGE_FLUSH_INTERVAL", 50))
+app.config["MESSAGE_BATCH_SIZE"] = int(os.getenv("MESSAGE_BATCH_SIZE", 200))
+app.config["MESSAGE_QUEUE_SIZE"] = int(os.getenv("MESSAGE_QUEUE_SIZE", 10000))
+app.config["SOCKETIO_MESSAGE_QUEUE"] = os.getenv("SOCKETIO_MESSAGE_QUEUE")
+app.config["USER_CACHE_SIZE"] = int(os.getenv("USER_CACHE_SIZE", 10000))
+app.config["USER_CACHE_TTL"] = int(os.getenv("USER_CACHE_TTL", 300))
+app.config["CHANNEL_PAGE_SIZE"] = int(os.getenv("CHANNEL_PAGE_SIZE", 50))
+app.config["MEMBER_PAGE_SIZE"] = int(os.getenv("MEMBER_PAGE_SIZE", 50))
+app.config["STATIC_MAX_AGE"] = int(os.getenv("STATIC_MAX_AGE", 31536000))
+app.config["COMPRESSION_LEVEL"] = int(os.getenv("COMPRESSION_LEVEL", 6))
+app.config["MESSAGE_COALESCE"] = os.getenv("MESSAGE_COALESCE", "false").lower() == "true"
+app.config["MESSAGE_COALESCE_LATENCY"] = int(os.getenv("MESSAGE_COALESCE_LATENCY", 20))
+app.config["MESSAGE_COALESCE_BATCH"] = int(os.getenv("MESSAGE_COALESCE_BATCH", 100))
+app.config["PROFILE_STORAGE"] = os.getenv("PROFILE_STORAGE", "cloudinary")
+app.config["PROFILE_IMAGE_SIZE"] = int(os.getenv("PROFILE_IMAGE_SIZE", 256))
+app.config["UPLOAD_FOLDER"] = os.getenv("UPLOAD_FOLDER") or os.path.join(tempfile.gettempdir(), "chat-group-uploads")
+app.config["UPLOAD_WORKERS"] = int(os.getenv("UPLOAD_WORKERS", 2))
+app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("UPLOAD_MAX_SIZE", 10 * 1024 * 1024))
+app.config["RECENT_MESSAGES_SIZE"] = int(os.getenv("RECENT_MESSAGES_SIZE", 200))
+app.config["RECENT_MESSAGES_CHANNELS"] = int(os.getenv("RECENT_MESSAGES_CHANNELS", 1024))
+app.config["FRAGMENT_CACHE_SIZE"] = int(os.getenv("FRAGMENT_CACHE_SIZE", 16 * 1024 * 1024))
+app.config["SOCKET_SEND_QUEUE_LIMIT"] = int(os.getenv("SOCKET_SEND_QUEUE_LIMIT", 1000))
+app.config["SLOW_CONSUMER_POLICY"] = os.getenv("SLOW_CONSUMER_POLICY", "resync")
+app.config["SLOW_QUERY_MS"] = int(os.getenv("SLOW_QUERY_MS")) if os.getenv("SLOW_QUERY_MS") else None
+app.config["METRICS_TOKEN"] = os.getenv("METRICS_TOKEN") or None
+app.config["PASSWORD_HASH_METHOD"] = os.getenv("PASSWORD_HASH_METHOD", "scrypt")
+app.config["PASSWORD_HASH_CONCURRENCY"] = int(os.getenv("PASSWORD_HASH_CONCURRENCY", 4))
+app.config["PASSWORD_HASH_TIMEOUT"] = float(os.getenv("PASSWORD_HASH_TIMEOUT", 10))
+app.config["LOGIN_RATE_LIMIT"] = int(os.getenv("LOGIN_RATE_LIMIT", 10))
+app.config["LOGIN_RATE_WINDOW"] = int(os.getenv("LOGIN_RATE_WINDOW", 60))
+app.config["TRUSTED_PROXIES"] = int(os.getenv("TRUSTED_PROXIES", 0))
+app.config["SESSION_TYPE"] = os.getenv("SESSION_TYPE", "sqlite")
+app.config["SESSION_CACHE_SIZE"] = int(os.getenv("SESSION_CACHE_SIZE", 10000))
+app.config["SESSION_POOL_SIZE"] = int(os.getenv("SESSION_POOL_SIZE", 4))
+app.config["SESSION_CACHE_TTL"] = int(os.getenv("SESSION_CACHE_TTL", 300))
+app.config["SESSION_CLEANUP_INTERVAL"] = int(os.getenv("SESSION_CLEANUP_INTERVAL", 600))
+
+# Configure Socket.IO, sharing rooms and bus events between workers through the message queue
+bus = Bus()
+socketio_options = {}
+if app.config["SOCKETIO_MESSAGE_QUEUE"]:
+    socketio_options["client_manager"] = create_client_manager(app.config["SOCKETIO_MESSAGE_QUEUE"], bus)
+socketio = SocketIO(app, async_mode="eventlet", json=WireJSON, **socketio_options)
+
+# Take the client address from the X-Forwarded-* headers set by trusted reverse proxies,
+# wrapping Socket.IO too so socket handlers see the same address
+if app.config["TRUSTED_PROXIES"]:
+    proxies = app.config["TRUSTED_PROXIES"]
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies, x_host=proxies)
+
+# Bound what is buffered for each client, slow ones resync or get disconnected
+dropped_events = registry.counter("chat_socket_dropped_events_total", "Socket.IO events dropped from full send queues")
+send_queue_overflows = registry.counter("chat_socket_send_queue_overflows_total", "Send queues that overflowed, by slow consumer policy", ("policy",))
+
+def count_overflow(dropped, policy):
+    dropped_events.inc(amount=dropped)
+    send_queue_overflows.inc(policy)
+
+outbound = None
+if app.config["SOCKET_SEND_QUEUE_LIMIT"]:
+    outbound = OutboundQueues(app.config["SOCKET_SEND_QUEUE_LIMIT"], app.config["SLOW_CONSUMER_POLICY"], on_overflow=count_overflow)
+    outbound.install(socketio.server)
+
+if app.config["SOCKETIO_MESSAGE_QUEUE"]:
+    # Start listening right away so bus events also reach workers without connected clients
+    socketio.server.manager_initialized = True
+    socketio.server.manager.initialize()
+
+# Fingerprint static asset URLs and compress responses
+static_versions = StaticVersions(app.static_folder)
+compress = Compressor(app.config["COMPRESSION_LEVEL"])
+
+@app.url_defaults
+def static_version(endpoint, values):
+    if endpoint == "static" and "filename" in values and "v" not in values:
+        version = static_versions.get(values["filename"])
+        if version:
+            values["v"] = version
 
 # Configure SQLite database
+pool = ConnectionPool(app.config["DATABASE"], app.config["DATABASE_POOL_SIZE"], app.config["DATABASE_POOL_TIMEOUT"], factory=TimedConnection)
+log_slow_queries(app.config["SLOW_QUERY_MS"])
+
+# Hash passwords off the event loop and slow down password guessing
+hasher = PasswordHasher(app.config["PASSWORD_HASH_METHOD"], app.config["PASSWORD_HASH_CONCURRENCY"], app.config["PASSWORD_HASH_TIMEOUT"])
+login_limiter = RateLimiter(app.config["LOGIN_RATE_LIMIT"], app.config["LOGIN_RATE_WINDOW"])
+
+@app.errorhandler(HasherBusy)
+def hasher_busy(e):
+    return apology("server is busy, try again later", 503)
+
 def get_db():
     db = getattr(g, "_database", None)
     if db is None:
-        db = g._database = sqlite3.connect(app.config["DATABASE"])
+        db = g._database = pool.acquire()
     return db
 
+def release_db():
+    """Hand the request's connection back before a slow step, get_db() takes a new one afterwards"""
+    db = g.pop("_database", None)
+    if db is not None:
+        pool.release(db)
+
+# Configure server-side sessions (instead of signed cookies), shared by every worker through
+# the database by default or any Flask-Session backend such as redis
+app.config["SESSION_PERMANENT"] = False
+if app.config["SESSION_TYPE"] == "sqlite":
+    # Sessions are saved after the request's own connection was taken and before it is
+    # released, so they get a pool of their own instead of waiting on the shared one
+    session_pool = ConnectionPool(app.config["DATABASE"], app.config["SESSION_POOL_SIZE"], app.config["DATABASE_POOL_TIMEOUT"], factory=TimedConnection)
+    app.session_interface = SQLiteSessionInterface(
+        app,
+        session_pool,
+        bus,
+        cache_size=app.config["SESSION_CACHE_SIZE"],
+        cache_ttl=app.config["SESSION_CACHE_TTL"],
+        cleanup_interval=app.config["SESSION_CLEANUP_INTERVAL"],
+        permanent=app.config["SESSION_PERMANENT"],
+    )
+    app.session_interface.start()
+else:
+    Session(app)
+
+# Per-connection socket state, keyed by sid
+connections = Connections()
+
+# Deliver new messages to busy rooms as batches when coalescing is enabled
+coalescer = None
+activity_coalescer = None
+if app.config["MESSAGE_COALESCE"]:
+    coalescer = Coalescer(
+        socketio,
+        "messages_batch",
+        max_latency=app.config["MESSAGE_COALESCE_LATENCY"] / 1000,
+        max_batch=app.config["MESSAGE_COALESCE_BATCH"],
+    )
+
+    # Unread counts only need the latest id and how many arrived, once per flush
+    activity_coalescer = Coalescer(
+        socketio,
+        "channel_activity",
+        max_latency=app.config["MESSAGE_COALESCE_LATENCY"] / 1000,
+        max_batch=app.config["MESSAGE_COALESCE_BATCH"],
+        pack=lambda batch: [batch[0][0], max(message_id for _, message_id in batch), len(batch)],
+    )
+
+# Latest messages of each channel, every worker adds the messages stored by any of them
+recent = RecentMessages(app.config["RECENT_MESSAGES_SIZE"], app.config["RECENT_MESSAGES_CHANNELS"])
+
+@bus.subscribe("message_stored")
+def buffer_message(payload):
+    recent.add(payload["channel_id"], payload["message"])
+
+@bus.subscribe("user_updated")
+def invalidate_recent_messages(user_id):
+    # Buffered rows carry names and pictures, like the member lists
+    recent.clear()
+
+
+def store_message(message_id, row, data):
+    """Buffer a message once it has an id in every worker and tell the other channels' members"""
+    
+    row["id"] = data.id = message_id
+    bus.publish("message_stored", {"channel_id": data.channel_id, "message": row})
+    broadcast_activity(data.channel_id, message_id)
+
+
+def messages_written(written):
+    # The messages were broadcast when queued, send the rooms their ids as [channel_id, [[key, id], ...]]
+    saved = {}
+    for message_id, (row, data) in written:
+        store_message(message_id, row, data)
+        saved.setdefault(data.channel_id, []).append([data.key, message_id])
+    
+    for channel_id, ids in saved.items():
+        socketio.emit("messages_saved", [channel_id, ids], to=channel_id)
+
+# Persist new messages in batches when write-behind is enabled
+writer = None
+if app.config["MESSAGE_WRITE_BEHIND"]:
+    writer = MessageWriter(
+        pool,
+        interval=app.config["MESSAGE_FLUSH_INTERVAL"] / 1000,
+        batch_size=app.config["MESSAGE_BATCH_SIZE"],
+        max_queue=app.config["MESSAGE_QUEUE_SIZE"],
+        on_written=messages_written,
+    )
+    writer.start()
+    atexit.register(writer.flush)
+
+# Cache user rows, every worker drops its copy when a profile changes
+user_cache = TTLCache(app.config["USER_CACHE_SIZE"], app.config["USER_CACHE_TTL"])
+
+@bus.subscribe("user_updated")
+def invalidate_user(user_id):
+    user_cache.delete(user_id)
+
+# Only the cached row holds the hash, rendered names and pictures stay valid
+@bus.subscribe("user_hash_changed")
+def invalidate_user_hash(user_id):
+    user_cache.delete(user_id)
+
+
+def get_user(user_id):
+    """Get a user from the cache, querying the database on a miss"""
+
+    user = user_cache.get(user_id)
+    if user is None:
+        cursor = get_db().cursor()
+        cursor.row_factory = sqlite3.Row
+        users = cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchall()
+        if len(users) == 0:
+            return None
+
+        user = dict(users[0])
+        user_cache.set(user_id, user)
+
+    # Callers are free to modify their copy
+    return dict(user)
+
+# Local date of the latest message in each channel, warmed lazily from the database
+channel_dates = {}
+
+@bus.subscribe("channel_date")
+def update_channel_date(payload):
+    if channel_dates.get(payload["channel_id"], "") < payload["date"]:
+        channel_dates[payload["channel_id"]] = payload["date"]
+
+
+def is_start_of_day(channel_id, today):
+    """Tell whether a new message is the first of the day in its channel, recording it"""
+
+    last_date = channel_dates.get(channel_id)
+    if last_date == today:
+        return False
+
+    # Unknown or older than today, another worker may already have a message today
+    messages = get_db().execute("SELECT created_at FROM messages WHERE channel_id = ? ORDER BY created_at DESC LIMIT 1", (channel_id,)).fetchall()
+    if len(messages) > 0 and local_date(messages[0][0]).isoformat() == today:
+        channel_dates[channel_id] = today
+        return False
+
+    # Let every worker know the channel already has a message today
+    bus.publish("channel_date", {"channel_id": channel_id, "date": today})
+    return True
+
+# Every channel in memory, reloaded when a channel is created in any worker
+directory = ChannelDirectory()
+
+def get_channel_directory():
+    """Return the channel directory, reloading it when channels were added"""
+
+    cursor = get_db().cursor()
+
+    # Channels are never edited or deleted, the highest id identifies the list
+    version = cursor.execute("SELECT MAX(id) FROM channels").fetchone()[0]
+    if version != directory.version:
+        cursor.row_factory = sqlite3.Row
+        channels = [dict(row) for row in cursor.execute("SELECT * FROM channels ORDER BY created_at DESC, id DESC").fetchall()]
+        for channel in channels:
+            channel["initial"] = make_initial(channel.get("name"))
+        directory.load(channels, version)
+
+    return directory
+
+# Rendered HTML of messages and channel lists, bounded by total size
+fragments = SizedCache(app.config["FRAGMENT_CACHE_SIZE"])
+
+@bus.subscribe("user_updated")
+def invalidate_fragments(user_id):
+    # Rendered messages carry names and pictures, like the member lists
+    fragments.clear()
+
+
+@app.template_global()
+def render_messages(messages):
+    """Render formatted message rows, reusing the HTML of rows rendered before"""
+    
+    template = app.jinja_env.get_template("components/message.html")
+    parts = []
+    for message in messages:
+        # Stored messages never change, only how their author and date are shown
+        key = ("message", message["id"], message["name"], message["profile_url"], message["created_at"], message.get("start_date_at"))
+        html = fragments.get(key)
+        if html is None:
+            html = template.render(message=message)
+            fragments.set(key, html)
+        parts.append(html)
+    return Markup("".join(parts))
+
+
+def render_channel_list(directory, name="", offset=0):
+    """Render a page of the channel list, once per channel list version and query"""
+    
+    key = ("channels", directory.version, name, offset)
+    html = fragments.get(key)
+    if html is None:
+        channels, total = directory.search(name, offset, app.config["CHANNEL_PAGE_SIZE"])
+        next_offset = offset + len(channels) if offset + len(channels) < total else None
+        html = render_template("components/channel.html", channels=channels, next_offset=next_offset, name=name)
+        fragments.set(key, html)
+    return Markup(html)
+
+# Channels each user is known to have joined, memberships are never removed
+memberships = TTLCache(100000, 86400)
+
+# Last message id each member is known to have read, to skip updates that change nothing
+read_markers = TTLCache(100000, 3600)
+
+# First page of members of each channel, kept current by member_joined events
+member_lists = TTLCache(1024, app.config["USER_CACHE_TTL"])
+
+@bus.subscribe("member_joined")
+def add_member(payload):
+    members = member_lists.get(payload["channel_id"])
+    if members is not None:
+        member_lists.set(payload["channel_id"], ([payload["member"]] + members)[:app.config["MEMBER_PAGE_SIZE"]])
+
+@bus.subscribe("user_updated")
+def invalidate_member_lists(user_id):
+    # Member lists carry names and pictures, profile edits are rare enough to drop them all
+    member_lists.clear()
+
+
+def get_unread_counts(cursor, user_id):
+    """Return the unread message count of each channel of a user that has any"""
+    
+    rows = cursor.execute("""
+        SELECT members.channel_id, channels.message_count - members.read_count FROM members
+        JOIN channels ON channels.id = members.channel_id
+        WHERE members.user_id = ? AND channels.message_count > members.read_count
+    """, (user_id,)).fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+def mark_read(db, channel_id, user_id, message_id):
+    """Move a member's read marker forward to `message_id` and tell the user's other pages"""
+    
+    if not message_id or read_markers.get((channel_id, user_id), 0) >= message_id:
+        return False
+    
+    # Messages after the marker are few, counting them keeps read_count exact
+    cursor = db.execute("""
+        UPDATE members SET
+            last_read_id = ?,
+            read_count = (SELECT message_count FROM channels WHERE id = ?) - (SELECT COUNT(*) FROM messages WHERE channel_id = ? AND id > ?)
+        WHERE channel_id = ? AND user_id = ? AND last_read_id < ?
+    """, (message_id, channel_id, channel_id, message_id, channel_id, user_id, message_id))
+    db.commit()
+    read_markers.set((channel_id, user_id), message_id)
+    
+    if cursor.rowcount == 1:
+        socketio.emit("channel_read", [channel_id, message_id], to="user:%s" % user_id)
+    return True
+
+
+def query_members(cursor, channel_id, before=None, limit=50):
+    """Query a page of channel members, newest first, older than the `before` member id"""
+
+    if before:
+        return cursor.execute("""
+            SELECT members.id, users.name, users.profile_url FROM members
+            JOIN users ON members.user_id = users.id
+            WHERE members.channel_id = ? AND members.id < ?
+            ORDER BY members.id DESC
+            LIMIT ?
+        """, (channel_id, before, limit)).fetchall()
+
+    return cursor.execute("""
+        SELECT members.id, users.name, users.profile_url FROM members
+        JOIN users ON members.user_id = users.id
+        WHERE members.channel_id = ?
+        ORDER BY members.id DESC
+        LIMIT ?
+    """, (channel_id, limit)).fetchall()
+
+
+def query_messages(cursor, channel_id, before=None, limit=20):
+    """Query a page of channel messages, newest first, older than the `before` message id"""
+
+    if before:
+        return cursor.execute("""
+            SELECT messages.id, users.name, users.profile_url, messages.message, messages.created_at, messages.is_start_date FROM messages
+            JOIN users ON messages.user_id = users.id
+            WHERE messages.channel_id = ? AND messages.id < ?
+            ORDER BY messages.id DESC
+            LIMIT ?
+        """, (channel_id, before, limit)).fetchall()
+
+    return cursor.execute("""
+        SELECT messages.id, users.name, users.profile_url, messages.message, messages.created_at, messages.is_start_date FROM messages
+        JOIN users ON messages.user_id = users.id
+        WHERE messages.channel_id = ?
+        ORDER BY messages.id DESC
+        LIMIT ?
+    """, (channel_id, limit)).fetchall()
+
+
+def get_recent_messages(cursor, channel_id, limit=20):
+    """Return the latest page of channel messages from the buffer, warming it from the database on a miss"""
+    
+    messages = recent.latest(channel_id, limit)
+    if messages is None:
+        messages = [dict(message) for message in query_messages(cursor, channel_id, limit=max(limit, recent.size))]
+        recent.warm(channel_id, messages)
+        messages = messages[:limit]
+    return messages
+
+
+def query_messages_after(cursor, channel_id, after, limit):
+    """Query up to `limit` channel messages newer than the `after` message id, oldest first"""
+    
+    return cursor.execute("""
+        SELECT messages.id, users.name, users.profile_url, messages.message, messages.created_at, messages.is_start_date FROM messages
+        JOIN users ON messages.user_id = users.id
+        WHERE messages.channel_id = ? AND messages.id > ?
+        ORDER BY messages.id
+        LIMIT ?
+    """, (channel_id, after, limit)).fetchall()
+
 # Set up Cloudinary
 cloudinary.config( 
   cloud_name = os.getenv("CLOUDINARY_CLOUD_NAME"), 
@@ -48,84 +477,359 @@ cloudinary.config(
   secure = True
 )
 
+def finish_profile_upload(user_id, profile_url):
+    """Save the stored picture of a user and tell their open pages about it"""
+    
+    db = pool.acquire()
+    try:
+        db.execute("UPDATE users SET profile_url = ? WHERE id = ?", (profile_url, user_id))
+        db.commit()
+    finally:
+        pool.release(db)
+    
+    # Drop cached copies of the user in every worker
+    bus.publish("user_updated", user_id)
+    socketio.emit("profile_updated", {"profile_url": profile_url}, to="user:%s" % user_id)
+
+# Process and store profile pictures in the background
+if app.config["PROFILE_STORAGE"] == "local":
+    # Cloudinary crops on its side, local files are only shrunk by Pillow
+    if not can_resize():
+        raise RuntimeError("PROFILE_STORAGE=local needs Pillow to resize profile pictures, run pip install -r requirements.txt")
+    profile_storage = LocalStorage(os.path.join(app.static_folder, "uploads"), "/static/uploads/")
+else:
+    profile_storage = CloudinaryStorage("chat-group", app.config["PROFILE_IMAGE_SIZE"])
+
+uploads = UploadPipeline(
+    profile_storage,
+    finish_profile_upload,
+    app.config["UPLOAD_FOLDER"],
+    size=app.config["PROFILE_IMAGE_SIZE"],
+    workers=app.config["UPLOAD_WORKERS"],
+)
+uploads.start()
+
 
-client_rooms = {}
+def is_member(channel_id, user_id):
+    """Check channel membership, remembering members so each pair hits the database once"""
+    
+    if memberships.get((channel_id, user_id)) is not None:
+        return True
+    
+    db = get_db()
+    member = db.execute("SELECT id FROM members WHERE channel_id = ? AND user_id = ?", (channel_id, user_id)).fetchone()
+    if member is None:
+        return False
+    
+    memberships.set((channel_id, user_id), True)
+    return True
 
-@socketio.on("reset_room")
-def reset_room():
-    """Refresh client rooms"""
+
+@socketio.on("connect")
+def connect(auth=None):
+    """Remember who is behind the connection, the only time socket events read the session"""
     
-    id = session.get("id")
-    channel_id = session.get("channel_id")
+    connection = connections.open(request.sid, session.get("user_id"))
     
-    if not id or not channel_id:
+    # Private room for notifications about the user's own account
+    if connection.user_id is None:
         return
+    join_room("user:%s" % connection.user_id)
+    
+    # Activity of every channel of the user, for unread counts
+    for member in get_db().execute("SELECT channel_id FROM members WHERE user_id = ?", (connection.user_id,)).fetchall():
+        join_room("activity:%d" % member[0])
+
 
-    # Leave current room
-    if id and id in client_rooms:
-        leave_room(client_rooms[id])
+@socketio.on("disconnect")
+def disconnect():
+    connections.close(request.sid)
 
-    # Join new room
-    if id and channel_id:
+
+@socketio.on("join_channel")
+def join_channel(channel_id):
+    """Follow a channel the user is a member of, a connection may follow many"""
+    
+    connection = connections.get(request.sid)
+    
+    if connection is None or connection.user_id is None or not isinstance(channel_id, int):
+        return False
+    
+    if not connection.follows(channel_id):
+        if not is_member(channel_id, connection.user_id):
+            return False
+        connection.channels.add(channel_id)
         join_room(channel_id)
-        client_rooms[id] = channel_id
+        
+        # Followed channels get the messages themselves, not activity
+        leave_room("activity:%d" % channel_id)
+    
+    if connection.active_channel is None:
+        connection.active_channel = channel_id
+    return True
+
+
+@socketio.on("leave_channel")
+def leave_channel(channel_id):
+    """Stop following a channel"""
+    
+    connection = connections.get(request.sid)
+    
+    if connection is None or not connection.follows(channel_id):
+        return False
+    
+    connection.channels.discard(channel_id)
+    leave_room(channel_id)
+    join_room("activity:%d" % channel_id)
+    
+    if connection.active_channel == channel_id:
+        connection.active_channel = None
+    return True
+
+
+@socketio.on("reset_room")
+def reset_room(channel_id=None):
+    """Follow only `channel_id`, or the channel selected over HTTP when none is given"""
+    
+    connection = connections.get(request.sid)
+    
+    if connection is None:
+        return False
+    
+    if channel_id is None:
+        channel_id = session.get("channel_id")
+    
+    if not channel_id or not join_channel(channel_id):
+        return False
+    
+    # Leave every other channel room
+    for followed in list(connection.channels):
+        if followed != channel_id:
+            leave_channel(followed)
+    
+    connection.active_channel = channel_id
+    return True
+
+
+@socketio.on("resume")
+def resume(data):
+    """Follow a channel again after reconnecting and return the messages newer than `after`.
+    
+    Answers from the recent messages buffer when it covers the gap, and with
+    one bounded query otherwise. When even that falls short the latest page is
+    returned with `gap` set, for the client to replace its list.
+    """
+    
+    if not isinstance(data, dict) or not isinstance(data.get("channel_id"), int) or not isinstance(data.get("after"), int):
+        return False
+    
+    channel_id = data["channel_id"]
+    if not reset_room(channel_id):
+        return False
+    
+    # Joined first, messages stored from now on also arrive in the room
+    messages = recent.since(channel_id, data["after"])
+    gap = False
+    if messages is None:
+        cursor = get_db().cursor()
+        cursor.row_factory = sqlite3.Row
+        messages = [dict(message) for message in query_messages_after(cursor, channel_id, data["after"], recent.size + 1)]
+        if len(messages) > recent.size:
+            messages = get_recent_messages(cursor, channel_id)[::-1]
+            gap = True
+    
+    return {"items": format_messages(messages), "gap": gap}
+
+
+@socketio.on("mark_read")
+def read_messages(data):
+    """Mark the messages of a followed channel read up to `message_id`"""
+    
+    connection = connections.get(request.sid)
+    
+    if connection is None or not isinstance(data, dict) or not isinstance(data.get("message_id"), int):
+        return False
+    
+    if not connection.follows(data.get("channel_id")):
+        return False
+    
+    mark_read(get_db(), data["channel_id"], connection.user_id, data["message_id"])
+    return True
+
+
+def broadcast_message(channel_id, data):
+    """Send a new message to the channel room, or queue it for the next batch"""
+    
+    if coalescer:
+        coalescer.add(channel_id, data)
+    else:
+        socketio.emit("new_message", data, to=channel_id)
+
+
+def broadcast_activity(channel_id, message_id):
+    """Tell members who don't follow the channel that it has a new message, as [channel_id, last_id, count]"""
+    
+    room = "activity:%d" % channel_id
+    if activity_coalescer:
+        activity_coalescer.add(room, (channel_id, message_id))
+    else:
+        socketio.emit("channel_activity", [channel_id, message_id, 1], to=room)
 
 
 @socketio.on("new_message")
 def new_message(message):  
-    """Broadcast new message to all clients in the channel"""  
+    """Broadcast new message to all clients in the channel, answering with an error when it was dropped"""  
     
-    if message == "" or "channel_id" not in session or "user_id" not in session:
+    connection = connections.get(request.sid)
+    
+    if connection is None or connection.user_id is None:
         return
     
-    # Get database connection
-    db = get_db()
-    cursor = db.cursor()
-    cursor.row_factory = sqlite3.Row
+    # Messages name their channel, plain strings go to the active one
+    if isinstance(message, dict):
+        channel_id = message.get("channel_id")
+        message = message.get("message")
+    else:
+        channel_id = connection.active_channel
     
-    # Query database for user
-    users = cursor.execute("SELECT * FROM users WHERE id = ?", (session["user_id"],)).fetchall()
+    if not message or not isinstance(message, str) or not connection.follows(channel_id):
+        return
     
-    # Query latest message
-    messages = cursor.execute("SELECT created_at FROM messages WHERE channel_id = ? ORDER BY created_at DESC LIMIT 1", (session["channel_id"],)).fetchall()
+    # Get sender from cache
+    user = get_user(connection.user_id)
     
     # Check if the message is the first message of the day
-    is_start_date = False
-    if len(messages) == 0:
-        is_start_date = True
-    elif datetime.now().date() != datetime.fromisoformat(messages[0]["created_at"]).date():
-        is_start_date = True
-    
-    # Insert new message into database
-    cursor.execute("INSERT INTO messages (channel_id, user_id, message, is_start_date) VALUES(?, ?, ?, ?)", (session["channel_id"], session["user_id"], message, is_start_date))
+    now = local_now()
+    is_start_date = is_start_of_day(channel_id, now.date().isoformat())
+    
+    # Buffered in every worker like a database row, created_at in UTC
+    created_at = now.astimezone(pytz.utc).strftime("%Y-%m-%d %H:%M:%S")
+    row = {"name": user["name"], "profile_url": user["profile_url"], "message": message, "created_at": created_at, "is_start_date": is_start_date}
+    
+    # Encoded once by the Socket.IO packet for every recipient in the room
+    data = NewMessage(
+        channel_id,
+        user["name"],
+        user["profile_url"],
+        "today at " + now.strftime("%I:%M %p"),
+        message,
+        now.strftime("%B %d, %Y") if is_start_date else None,
+    )
+
+    if writer:
+        # Queue the message for the background writer and broadcast it right away,
+        # the sender waits here only when the queue is full
+        row["key"] = data.key = uuid.uuid4().hex
+        try:
+            writer.put(channel_id, connection.user_id, message, is_start_date, created_at, (row, data))
+        except queue.Full:
+            # Answer the sender so the message can be sent again
+            app.logger.warning("Message queue is full, dropping message from user %s", connection.user_id)
+            return {"error": "The server is busy, try sending the message again"}
+        
+        broadcast_message(channel_id, data)
+        return
+
+    # Insert new message into database, the only step here that always needs a connection
+    db = get_db()
+    message_id = db.execute("INSERT INTO messages (channel_id, user_id, message, is_start_date, created_at) VALUES(?, ?, ?, ?, ?)", (channel_id, connection.user_id, message, is_start_date, created_at)).lastrowid
     db.commit()
 
-    data = { 
-        "name": users[0]["name"],
-        "profile_url": users[0]["profile_url"],
-        "created_at": "today at " + datetime.now().strftime("%I:%M %p"),
-        "message": message,
-    }
+    store_message(message_id, row, data)
+    broadcast_message(channel_id, data)
     
-    if is_start_date:
-        data["start_date_at"] = datetime.now().strftime("%B %d, %Y")
 
-    emit("new_message", json.dumps(data), include_self=True, to=session["channel_id"])
-    
+# Instrument requests, socket events and templates for the /metrics endpoint
+request_seconds = registry.histogram("chat_http_request_seconds", "Time to handle HTTP requests, by endpoint", ("endpoint", "method", "status"))
+event_seconds = registry.histogram("chat_socket_event_seconds", "Time to handle Socket.IO events, by event", ("event",))
+render_seconds = registry.histogram("chat_template_render_seconds", "Time to render templates, by template", ("template",))
+
+registry.gauge("chat_db_pool_connections", "Database connections by state", lambda: {key: pool.stats()[key] for key in ("in_use", "idle", "waiting")}, ("state",))
+registry.gauge("chat_socket_connections", "Open Socket.IO connections in this worker", lambda: connections.stats()["connections"])
+registry.gauge("chat_socket_subscriptions", "Channels followed by the open connections", lambda: connections.stats()["subscriptions"])
+registry.gauge("chat_socket_rooms", "Channel rooms with connections in this worker", lambda: sum(1 for room in socketio.server.manager.rooms.get("/", {}) if isinstance(room, int)))
+registry.gauge("chat_password_hashes", "Password hashes running in the thread pool", lambda: hasher.active)
+registry.gauge("chat_upload_queue", "Profile pictures waiting to be processed", lambda: uploads.pending())
+if outbound:
+    registry.gauge("chat_socket_send_queue_packets", "Packets waiting in the send queues of all sockets", lambda: outbound.stats()["queued"])
+    registry.gauge("chat_socket_send_queue_deepest", "Packets waiting in the fullest send queue", lambda: outbound.stats()["deepest"])
+if writer:
+    registry.gauge("chat_message_queue", "Messages waiting for the background writer", lambda: writer.pending())
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    # Registered before the other after_request handlers, so it runs last and times them too
+    if "request_start" in g:
+        request_seconds.observe(time.perf_counter() - g.request_start, request.endpoint or "none", request.method, response.status_code)
+    return response
+
+handle_event = socketio._handle_event
+
+def timed_handle_event(handler, message, namespace, sid, *args):
+    start = time.perf_counter()
+    try:
+        return handle_event(handler, message, namespace, sid, *args)
+    finally:
+        event_seconds.observe(time.perf_counter() - start, message)
+
+socketio._handle_event = timed_handle_event
+
+@before_render_template.connect_via(app)
+def start_render(sender, template, context, **extra):
+    g.setdefault("render_starts", []).append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def record_render(sender, template, context, **extra):
+    if g.get("render_starts"):
+        render_seconds.observe(time.perf_counter() - g.render_starts.pop(), template.name)
+
 
 @app.teardown_appcontext
 def close_connection(exception):
     db = getattr(g, "_database", None)
     if db is not None:
-        db.close()
+        pool.release(db)
 
 @app.after_request
 def after_request(response):
-    """Ensure responses aren"t cached"""
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Expires"] = 0
-    response.headers["Pragma"] = "no-cache"
-    return response
+    """Ensure responses aren"t cached, unless the route set its own caching, and compress them"""
+    if request.endpoint == "static" and "v" in request.args:
+        # Fingerprinted URLs change whenever the file does
+        response.headers["Cache-Control"] = "public, max-age=%d, immutable" % app.config["STATIC_MAX_AGE"]
+    elif "Cache-Control" not in response.headers:
+        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+        response.headers["Expires"] = 0
+        response.headers["Pragma"] = "no-cache"
+    
+    return compress(request, response)
+
+@app.route("/metrics")
+@metrics_access_required
+def metrics():
+    """Show request, socket, query and template timings in the Prometheus text format"""
+    return app.response_class(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/metrics/database")
+@metrics_access_required
+def database_metrics():
+    """Show database connection pool usage"""
+    return jsonify(pool.stats())
+
+
+@app.route("/metrics/cache")
+@metrics_access_required
+def cache_metrics():
+    """Show cache hit rates"""
+    stats = {"users": user_cache.stats(), "recent_messages": recent.stats(), "fragments": fragments.stats()}
+    if isinstance(app.session_interface, SQLiteSessionInterface):
+        stats["sessions"] = app.session_interface.stats()
+    return jsonify(stats)
+
 
 @app.route("/")
 @login_required
@@ -137,37 +841,21 @@ def index():
     cursor = db.cursor()
     cursor.row_factory = sqlite3.Row
     
-    # Query database for channels
-    rows = cursor.execute("SELECT * FROM channels ORDER BY created_at DESC").fetchall()
+    # Get first page of channels, rendered once for everyone
+    channel_list = render_channel_list(get_channel_directory())
     
-    # Query database for user
-    users = cursor.execute("SELECT * FROM users WHERE id = ?", (session["user_id"],)).fetchall()
+    # Get user from cache
+    user = get_user(session["user_id"])
     
     # Query database for messages
     messages = []
     
     if "channel_id" in session:
-        messages = cursor.execute("""
-            SELECT users.name, users.profile_url, messages.message, messages.created_at, messages.is_start_date FROM messages
-            JOIN users ON messages.user_id = users.id
-            WHERE channel_id = ?
-            ORDER BY messages.created_at DESC
-            LIMIT 20
-        """, (session["channel_id"],)).fetchall()
-    
-    channels = [dict(row) for row in rows]
-
-    for channel in channels:
-        channel["initial"] = make_initial(channel.get("name"))
-        
-    messages = [dict(message) for message in messages]
+        before = request.args.get("before", type=int)
+        messages = query_messages(cursor, session["channel_id"], before) if before else get_recent_messages(cursor, session["channel_id"])
     
     # Convert iso date to human readable date
-    for message in messages:
-        if message["is_start_date"]:
-            message["start_date_at"] = datetime.fromisoformat(message["created_at"]).strftime("%B %d, %Y")
-            
-        message["created_at"] = format_message_date(message["created_at"])
+    messages = format_messages([dict(message) for message in messages])
     
     # Get current active channel
     active_channel = None
@@ -175,8 +863,12 @@ def index():
     if "channel_id" in session:
         active_channel = cursor.execute("SELECT * FROM channels WHERE id = ? LIMIT 1", (session["channel_id"],)).fetchall()
         active_channel = dict(active_channel[0])
+        mark_read(db, active_channel["id"], user["id"], active_channel["last_message_id"])
+    
+    # Unread counts of every channel of the user, in one query
+    unread = get_unread_counts(cursor, user["id"])
     
-    return render_template("home.html", channels=channels, user=users[0], channel=active_channel, messages=messages)
+    return render_template("home.html", channel_list=channel_list, user=user, channel=active_channel, messages=messages, unread=unread)
 
 
 @app.route("/register", methods=["GET", "POST"])
@@ -226,10 +918,19 @@ def register():
         if (len(rows) > 0):
             return apology("username or email already exists", 400)
 
-        password_hash = generate_password_hash(password)
+        # Don't hold a database connection while waiting for the hash
+        release_db()
+        password_hash = hasher.hash(password)
+
         # Register new user into database
-        user_id = cursor.execute("INSERT INTO users (username, email, name, hash) VALUES(?, ?, ?, ?)", (username, email, name, password_hash)).lastrowid
-        db.commit()
+        db = get_db()
+        cursor = db.cursor()
+        try:
+            user_id = cursor.execute("INSERT INTO users (username, email, name, hash) VALUES(?, ?, ?, ?)", (username, email, name, password_hash)).lastrowid
+            db.commit()
+        except sqlite3.IntegrityError:
+            # Taken by another registration while hashing
+            return apology("username or email already exists", 400)
         
         # Remember which user are already registered
         session["user_id"] = user_id
@@ -257,6 +958,10 @@ def login():
         elif not request.form.get("password"):
             return apology("must provide password", 403)
         
+        # Limit failed attempts per client, checked before spending time on a hash
+        if login_limiter.blocked(request.remote_addr):
+            return apology("too many login attempts, try again later", 429)
+
         # Get database connection
         db = get_db()
         cursor = db.cursor()
@@ -265,12 +970,23 @@ def login():
         # Query database for username
         rows = cursor.execute("SELECT * FROM users WHERE username = ?", (request.form.get("username"),)).fetchall()
 
+        # Don't hold a database connection while waiting for the hash, a login burst
+        # would take the connections chat messages need
+        release_db()
+
         # Ensure username exists and password is correct
-        if len(rows) != 1 or not check_password_hash(
-            rows[0]["hash"], request.form.get("password")
-        ):
+        if len(rows) != 1 or not hasher.check(rows[0]["hash"], request.form.get("password")):
+            login_limiter.hit(request.remote_addr)
             return apology("invalid username and/or password", 403)
 
+        # Upgrade hashes made with older parameters while the password is at hand
+        if hasher.needs_rehash(rows[0]["hash"]):
+            password_hash = hasher.hash(request.form.get("password"))
+            db = get_db()
+            db.execute("UPDATE users SET hash = ? WHERE id = ?", (password_hash, rows[0]["id"]))
+            db.commit()
+            bus.publish("user_hash_changed", rows[0]["id"])
+
         # Remember which user has logged in
         session["user_id"] = rows[0]["id"]
         session["id"] = uuid.uuid4()
@@ -297,18 +1013,12 @@ def logout():
 @login_required
 def profile():
     """Show user profile"""
-    # Get database connection
-    db = get_db()
-    cursor = db.cursor()
-    cursor.row_factory = sqlite3.Row
-    
-    users = cursor.execute("SELECT * FROM users WHERE id = ?", (session["user_id"],)).fetchall()
+    user = get_user(session["user_id"])
 
     # Convert UTC time to environment timezone
-    created_at = datetime.strptime(users[0]["created_at"], "%Y-%m-%d %H:%M:%S").replace(tzinfo=pytz.utc)
+    created_at = datetime.strptime(user["created_at"], "%Y-%m-%d %H:%M:%S").replace(tzinfo=pytz.utc)
     created_at = created_at.astimezone(pytz.timezone(app.config["TIMEZONE"])).strftime("%Y-%m-%d %H:%M:%S")
     
-    user = dict(users[0])
     user["created_at"] = created_at
     
     return render_template("profile/index.html", user=user)
@@ -324,7 +1034,7 @@ def edit_profile():
     cursor = db.cursor()
     cursor.row_factory = sqlite3.Row
     
-    users = cursor.execute("SELECT * FROM users WHERE id = ?", (session["user_id"],)).fetchall()
+    user = get_user(session["user_id"])
      
     if request.method == "POST":
         username = request.form.get("username")
@@ -356,44 +1066,45 @@ def edit_profile():
         if len(rows) > 0 and rows[0]["id"] != session["user_id"]:
             return apology("username or email already exists", 400)
         
+        # Ensure password match before accepting any upload, without holding a
+        # database connection while waiting for the hash
+        release_db()
+        if not hasher.check(user["hash"], password):
+            return apology("invalid password", 403)
+        
         # Ensure if user uploaded a profile picture
-        profile_url = users[0]["profile_url"]
-        if "profile_url" in request.files:
-            profile_picture = request.files["profile_url"]
+        profile_picture = request.files.get("profile_url")
+        if profile_picture:
+            if not allowed_file(profile_picture.filename):
+                return apology("file type not allowed", 400)
             
-            if profile_picture:
-                if profile_picture.filename == "":
-                    return apology("no file selected", 400)
-                
-                if not allowed_file(profile_picture.filename):
-                    return apology("file type not allowed", 400)
-                
-                # Upload profile picture to Cloudinary
-                profile_url = cloudinary.uploader.upload(profile_picture,
-                    folder="chat-group",
-                    public_id=session["user_id"],
-                    overwrite=True,
-                )["url"]
-        
-        # Ensure password match
-        if not check_password_hash(users[0]["hash"], password):
-            return apology("invalid password", 403)
+            # Store the picture in the background, open pages update when it's ready
+            try:
+                uploads.submit(session["user_id"], profile_picture, profile_picture.filename.rsplit(".", 1)[1].lower())
+            except queue.Full:
+                return apology("too many uploads, try again later", 503)
         
         # Update user profile
-        cursor.execute("UPDATE users SET username = ?, email = ?, name = ?, profile_url = ? WHERE id = ?", (username, email, name, profile_url, session["user_id"]))
+        db = get_db()
+        db.execute("UPDATE users SET username = ?, email = ?, name = ? WHERE id = ?", (username, email, name, session["user_id"]))
         db.commit()
         
-        user = dict(users[0])
+        # Drop cached copies of the user in every worker
+        bus.publish("user_updated", session["user_id"])
+        
         user["username"] = username
         user["email"] = email
         user["name"] = name
-        user["profile_url"] = profile_url
+        
+        if profile_picture:
+            flash("Your profile has been updated! Your new picture will appear shortly.")
+            return render_template("profile/index.html", user=user)
         
         # Redirect user to home page
         flash("Your profile has been updated!")
         return render_template("profile/index.html", user=user)
 
-    return render_template("profile/edit.html", user=users[0])
+    return render_template("profile/edit.html", user=user)
 
 
 @app.route("/password", methods=["GET", "POST"])
@@ -425,7 +1136,10 @@ def password():
         
         users = cursor.execute("SELECT hash FROM users WHERE id = ?", (session["user_id"],)).fetchall()
 
-        if not check_password_hash(users[0]["hash"], old):
+        # Don't hold a database connection while waiting for the hashes
+        release_db()
+
+        if not hasher.check(users[0]["hash"], old):
             return apology("old password didn't match", 403)
 
         # Validate new password
@@ -434,10 +1148,12 @@ def password():
         if isvalid is False:
             return apology(message, 400)
 
-        password_hash = generate_password_hash(password)
+        password_hash = hasher.hash(password)
         # Update password hash
-        cursor.execute("UPDATE users SET hash = ? WHERE id = ?", (password_hash, session["user_id"]))
+        db = get_db()
+        db.execute("UPDATE users SET hash = ? WHERE id = ?", (password_hash, session["user_id"]))
         db.commit()
+        bus.publish("user_hash_changed", session["user_id"])
 
         # Redirect user to home page
         flash("Password Changed!")
@@ -478,6 +1194,48 @@ def create_channel():
     return redirect("/channel/" + str(channel_id))
 
 
+def open_channel(db, cursor, channel_id, user):
+    """Join a channel and load its details and first page of members, None if it doesn't exist"""
+    
+    # Query database for channel
+    channels = cursor.execute("SELECT * FROM channels WHERE id = ? LIMIT 1", (channel_id,)).fetchall()
+    
+    if not channels:
+        return None
+    
+    channel = dict(channels[0])
+    
+    # Join the channel, the unique membership index turns this into a no-op for members
+    is_new_member = False
+    if memberships.get((channel_id, user["id"])) is None:
+        cursor.execute("INSERT OR IGNORE INTO members (channel_id, user_id) VALUES(?, ?)", (channel_id, user["id"]))
+        is_new_member = cursor.rowcount == 1
+        member_id = cursor.lastrowid
+        db.commit()
+        memberships.set((channel_id, user["id"]), True)
+    
+    # Send new member data to every worker and connected client
+    if is_new_member:
+        channel["member_count"] += 1
+        member = {"id": member_id, "name": user["name"], "profile_url": user["profile_url"]}
+        bus.publish("member_joined", {"channel_id": channel_id, "member": member})
+        emit("new_member", NewMember(channel_id, member["name"], member["profile_url"], channel["member_count"]), include_self=True, to=channel_id, namespace="/")
+    
+    # Opening a channel shows its latest messages
+    mark_read(db, channel_id, user["id"], channel["last_message_id"])
+    
+    # Get first page of members from cache
+    members = member_lists.get(channel_id)
+    if members is None:
+        members = [dict(member) for member in query_members(cursor, channel_id, limit=app.config["MEMBER_PAGE_SIZE"])]
+        member_lists.set(channel_id, members)
+    
+    channel["initial"] = make_initial(channel["name"])
+    channel["members"] = members
+    channel["members_before"] = members[-1]["id"] if len(members) == app.config["MEMBER_PAGE_SIZE"] else None
+    return channel
+
+
 @app.route("/channel/<int:channel_id>")
 @login_required
 def channel_detail(channel_id):
@@ -488,58 +1246,24 @@ def channel_detail(channel_id):
     cursor = db.cursor()
     cursor.row_factory = sqlite3.Row
     
-    # Query database for channel
-    channels = cursor.execute("SELECT * FROM channels WHERE id = ? LIMIT 1", (channel_id,)).fetchall()
-    
-    # Query database for user
-    users = cursor.execute("SELECT * FROM users WHERE id = ?", (session["user_id"],)).fetchall()
-    
-    # Check and insert new member into channel if not exists
-    members = cursor.execute("SELECT * FROM members WHERE channel_id = ? AND user_id = ?", (channel_id, session["user_id"])).fetchall()
-    
-    is_new_member = False
-    if len(members) == 0:
-        # Register new member into channel
-        is_new_member = True
-        cursor.execute("INSERT INTO members (channel_id, user_id) VALUES(?, ?)", (channel_id, session["user_id"]))
-        db.commit()
-        
-    members = cursor.execute("""
-        SELECT users.name, users.profile_url FROM members
-        JOIN users ON members.user_id = users.id
-        WHERE channel_id = ?
-        ORDER BY members.created_at DESC
-    """, (channel_id,)).fetchall()
+    # Get user from cache
+    user = get_user(session["user_id"])
     
-    # Send new member data to connected clients
-    if is_new_member:
-        emit("new_member", json.dumps(dict(members[0])), include_self=True, to=channel_id, namespace="/")
+    channel = open_channel(db, cursor, channel_id, user)
     
-    # Query database for messages
-    messages = cursor.execute("""
-        SELECT users.name, users.profile_url, messages.message, messages.created_at, messages.is_start_date FROM messages
-        JOIN users ON messages.user_id = users.id
-        WHERE channel_id = ?
-        ORDER BY messages.created_at DESC
-        LIMIT 20
-    """, (channel_id,)).fetchall()
+    if channel is None:
+        return apology("channel not found", 404)
     
-    channel = dict(channels[0])
-    channel["members"] = [dict(member) for member in members]
-    user = dict(users[0])
+    # Get messages from the buffer, older pages from the database
+    before = request.args.get("before", type=int)
+    messages = query_messages(cursor, channel_id, before) if before else get_recent_messages(cursor, channel_id)
     
     # Truncate description if it's too long
     if len(channel["description"]) > 100:
         channel["description"] = channel["description"][:100] + "..."
     
-    messages = [dict(message) for message in messages]
-    
     # Convert iso date to human readable date
-    for message in messages:
-        if message["is_start_date"]:
-            message["start_date_at"] = datetime.fromisoformat(message["created_at"]).strftime("%B %d, %Y")
-            
-        message["created_at"] = format_message_date(message["created_at"])
+    messages = format_messages([dict(message) for message in messages])
 
     # Remember which channel has been selected  
     session["channel_id"] = channel_id
@@ -547,38 +1271,110 @@ def channel_detail(channel_id):
     return render_template("channel.html", channel=channel, user=user, messages=messages) 
 
 
+@app.route("/channel/<int:channel_id>/members", methods=["GET"])
+@login_required
+def load_members(channel_id):
+    """Load more channel members"""
+    
+    before = request.args.get("before", type=int)
+    
+    # Get database connection
+    db = get_db()
+    cursor = db.cursor()
+    cursor.row_factory = sqlite3.Row
+    
+    members = [dict(member) for member in query_members(cursor, channel_id, before, app.config["MEMBER_PAGE_SIZE"])]
+    
+    # Cursor for the next (older) page
+    next_before = members[-1]["id"] if len(members) == app.config["MEMBER_PAGE_SIZE"] else None
+    
+    return conditional_json({ "items": members, "next_before": next_before })
+
+
 @app.route("/channel/search", methods=["GET"])
 @login_required
 def search_channel():
     """Search channel by name"""
     
-    name = request.args.get("name")
+    name = request.args.get("name", "")
+    offset = request.args.get("offset", 0, type=int)
+    
+    directory = get_channel_directory()
+    
+    # Same channel list version and query always render the same fragment
+    etag = "channels-%s-%s" % (directory.version, hashlib.sha1(("%s|%d" % (name, offset)).encode()).hexdigest())
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(render_channel_list(directory, name, offset))
+    
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+@app.route("/search", methods=["GET"])
+@login_required
+def search():
+    """Search messages and channels"""
+    
+    text = request.args.get("q", "")
+    channel_id = request.args.get("channel_id", type=int)
+    sort = request.args.get("sort", "rank")
+    after = request.args.get("cursor")
+    limit = request.args.get("limit", 20, type=int)
+    
+    if limit > 50:
+        limit = 50
+    elif limit < 1:
+        limit = 1
+    
+    if sort not in ("rank", "recent"):
+        return jsonify({"error": "sort must be rank or recent"}), 400
     
     # Get database connection
     db = get_db()
     cursor = db.cursor()
     cursor.row_factory = sqlite3.Row
     
-    # Query database for channels
-    rows = cursor.execute("SELECT * FROM channels WHERE name LIKE ? ORDER BY created_at DESC", ("%" + name + "%",)).fetchall()
+    # Query full-text index for messages
+    try:
+        messages, next_cursor = search_messages(cursor, text, channel_id, sort, after, limit)
+    except ValueError:
+        return jsonify({"error": "invalid cursor"}), 400
     
-    channels = [dict(row) for row in rows]
+    messages = [dict(message) for message in messages]
+    for message in messages:
+        message.pop("rank", None)
+    
+    # Convert iso date to human readable date
+    messages = format_messages(messages)
     
-    for channel in channels:
-        channel["initial"] = make_initial(channel.get("name"))
+    # Matching channels are only listed with the first page
+    channels = []
+    if not after and not channel_id:
+        channels = [dict(row) for row in search_channels(cursor, text)]
+        for channel in channels:
+            channel["initial"] = make_initial(channel.get("name"))
     
-    return render_template("components/channel.html", channels=channels)
+    return jsonify({ "items": messages, "channels": channels, "next_cursor": next_cursor })
+
 
 @app.route("/messages", methods=["GET"])
 @login_required
 def load_messages():
     """Load more messages"""
     
-    page = int(request.args.get("page")) or 1
-    pageSize = int(request.args.get("pageSize")) or 10
+    page = request.args.get("page", 1, type=int) or 1
+    pageSize = request.args.get("pageSize", 10, type=int) or 10
+    before = request.args.get("before", type=int)
+    
+    if page < 1:
+        page = 1
     
     if pageSize > 50:
         pageSize = 50
+    elif pageSize < 1:
+        pageSize = 1
     
     # Get database connection
     db = get_db()
@@ -588,25 +1384,107 @@ def load_messages():
     if "channel_id" not in session:
         return jsonify({"error": "channel not found"})
     
-    # Query database for messages
-    messages = cursor.execute("""
-        SELECT users.name, users.profile_url, messages.message, messages.created_at, messages.is_start_date FROM messages
-        JOIN users ON messages.user_id = users.id
-        WHERE channel_id = ?
-        ORDER BY messages.created_at DESC
-        LIMIT ? OFFSET ?
-    """, (session["channel_id"], pageSize, (page - 1) * pageSize)).fetchall()
-    
-    messages = [dict(message) for message in messages]
+    # Query database for messages, seeking past the cursor when one is given
+    if before:
+        messages = query_messages(cursor, session["channel_id"], before, pageSize)
+    else:
+        messages = cursor.execute("""
+            SELECT messages.id, users.name, users.profile_url, messages.message, messages.created_at, messages.is_start_date FROM messages
+            JOIN users ON messages.user_id = users.id
+            WHERE messages.channel_id = ?
+            ORDER BY messages.id DESC
+            LIMIT ? OFFSET ?
+        """, (session["channel_id"], pageSize, (page - 1) * pageSize)).fetchall()
     
     # Convert iso date to human readable date
-    for message in messages:
-        if message["is_start_date"]:
-            message["start_date_at"] = datetime.fromisoformat(message["created_at"]).strftime("%B %d, %Y")
-            
-        message["created_at"] = format_message_date(message["created_at"])
+    messages = format_messages([dict(message) for message in messages])
+        
+    # Cursor for the next (older) page
+    next_before = messages[-1]["id"] if len(messages) == pageSize else None
         
-    return jsonify({ "page": page, "page_size": pageSize, "items": messages })
+    return jsonify({ "page": page, "page_size": pageSize, "next_before": next_before, "items": messages })
+
+@app.route("/api/channels/<int:channel_id>", methods=["GET"])
+@login_required
+def api_channel(channel_id):
+    """Join a channel and return its details, first page of members and latest messages"""
+    
+    # Get database connection
+    db = get_db()
+    cursor = db.cursor()
+    cursor.row_factory = sqlite3.Row
+    
+    # Get user from cache
+    user = get_user(session["user_id"])
+    
+    channel = open_channel(db, cursor, channel_id, user)
+    
+    if channel is None:
+        return jsonify({"error": "channel not found"}), 404
+    
+    # Remember which channel has been selected  
+    session["channel_id"] = channel_id
+    
+    messages = get_recent_messages(cursor, channel_id)
+    last_modified = messages_modified_at(messages[0]["created_at"] if messages else None)
+    
+    # Convert iso date to human readable date
+    messages = format_messages(messages)
+    
+    members = channel.pop("members")
+    members_before = channel.pop("members_before")
+    next_before = messages[-1]["id"] if len(messages) == 20 else None
+    
+    return conditional_json({
+        "channel": channel,
+        "members": { "items": members, "next_before": members_before },
+        "messages": { "items": messages, "next_before": next_before },
+    }, last_modified)
+
+
+@app.route("/api/unread", methods=["GET"])
+@login_required
+def api_unread():
+    """Return the unread message counts of the user's channels, for pages coming back online"""
+    
+    # Get database connection
+    db = get_db()
+    cursor = db.cursor()
+    
+    unread = get_unread_counts(cursor, session["user_id"])
+    
+    return jsonify({ "items": [{ "channel_id": channel_id, "unread": count } for channel_id, count in unread.items()] })
+
+
+@app.route("/api/channels/<int:channel_id>/messages", methods=["GET"])
+@login_required
+def api_messages(channel_id):
+    """Return a page of channel messages older than the `before` cursor"""
+    
+    before = request.args.get("before", type=int)
+    limit = request.args.get("limit", 20, type=int)
+    
+    if limit > 50:
+        limit = 50
+    elif limit < 1:
+        limit = 1
+    
+    # Get database connection
+    db = get_db()
+    cursor = db.cursor()
+    cursor.row_factory = sqlite3.Row
+    
+    messages = [dict(message) for message in query_messages(cursor, channel_id, before, limit)]
+    last_modified = messages_modified_at(messages[0]["created_at"] if messages else None)
+    
+    # Convert iso date to human readable date
+    messages = format_messages(messages)
+    
+    # Cursor for the next (older) page
+    next_before = messages[-1]["id"] if len(messages) == limit else None
+    
+    return conditional_json({ "items": messages, "next_before": next_before }, last_modified)
+
 
 if __name__ == '__main__':
     socketio.run(app)
@@ -0,0 +1,321 @@
+"""Export chat history to NDJSON and import it back.
+
+Usage:
+    python archive.py export [--channel ID] [--database PATH] FILE    Write users, channels, members and messages
+    python archive.py import [--database PATH] FILE                   Load an export into the database
+
+FILE ending in .gz is gzip compressed. Each line is a JSON object whose "type"
+is header, user, channel, member, message or end, rows follow in id order.
+Exports stream the rows in chunks, checkpointing after each one, and imports
+commit in large transactions with the secondary indexes and triggers of members
+and messages dropped until the end. Both keep FILE.checkpoint while running, so
+an interrupted run picks up where it stopped when started again with the same
+arguments. Stop the app while importing.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sqlite3
+import sys
+
+from dotenv import load_dotenv
+
+from database import PRAGMAS
+from migrate import list_migrations, migrate
+
+FORMAT = 1
+
+# Rows written per chunk of an export, and lines committed per transaction of an import
+EXPORT_CHUNK = 50000
+IMPORT_BATCH = 100000
+
+# In dependency order, counters kept by triggers are left out and rebuilt on import
+TABLES = {
+    "user": ("users", ("id", "username", "email", "name", "hash", "profile_url", "created_at")),
+    "channel": ("channels", ("id", "name", "description", "created_at", "admin_id")),
+    "member": ("members", ("id", "created_at", "user_id", "channel_id", "last_read_id", "read_count")),
+    "message": ("messages", ("id", "created_at", "user_id", "channel_id", "message", "is_start_date")),
+}
+
+
+def export_query(kind, channel_id, after):
+    """Return the query and parameters reading the rows of one type after id `after`, in id order"""
+
+    if channel_id is None:
+        queries = {
+            "user": "SELECT id, username, email, name, hash, profile_url, created_at FROM users WHERE id > ? ORDER BY id",
+            "channel": "SELECT id, name, description, created_at, admin_id FROM channels WHERE id > ? ORDER BY id",
+            "member": "SELECT id, created_at, user_id, channel_id, last_read_id, read_count FROM members WHERE id > ? ORDER BY id",
+            "message": "SELECT id, created_at, user_id, channel_id, message, is_start_date FROM messages WHERE id > ? ORDER BY id",
+        }
+        return queries[kind], (after,)
+
+    # Users of a channel are its admin, its members and everyone who wrote in it
+    if kind == "user":
+        return (
+            "SELECT id, username, email, name, hash, profile_url, created_at FROM users WHERE id > ? AND id IN "
+            "(SELECT admin_id FROM channels WHERE id = ? UNION SELECT user_id FROM members WHERE channel_id = ? UNION SELECT user_id FROM messages WHERE channel_id = ?) "
+            "ORDER BY id"
+        ), (after, channel_id, channel_id, channel_id)
+    if kind == "channel":
+        return "SELECT id, name, description, created_at, admin_id FROM channels WHERE id = ? AND id > ?", (channel_id, after)
+    if kind == "member":
+        return "SELECT id, created_at, user_id, channel_id, last_read_id, read_count FROM members WHERE channel_id = ? AND id > ? ORDER BY id", (channel_id, after)
+    return "SELECT id, created_at, user_id, channel_id, message, is_start_date FROM messages WHERE channel_id = ? AND id > ? ORDER BY id", (channel_id, after)
+
+
+def read_checkpoint(path):
+    try:
+        with open(path + ".checkpoint") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_checkpoint(path, checkpoint):
+    """Replace the checkpoint atomically, a crash leaves either the old or the new one"""
+
+    with open(path + ".checkpoint.tmp", "w") as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".checkpoint.tmp", path + ".checkpoint")
+
+
+def connect(database):
+    db = sqlite3.connect(database, timeout=30, isolation_level=None)
+    for name, value in PRAGMAS.items():
+        db.execute("PRAGMA %s = %s" % (name, value))
+    return db
+
+
+def export_file(database, path, channel_id=None):
+    """Write the rows of the whole database, or of one channel, to `path` and return how many of each type"""
+
+    db = connect(database)
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    if version != list_migrations()[-1][0]:
+        sys.exit("%s is at schema version %d, run migrate.py first" % (database, version))
+
+    compress = path.endswith(".gz")
+    checkpoint = read_checkpoint(path)
+    if checkpoint is None or checkpoint["channel_id"] != channel_id:
+        checkpoint = {"channel_id": channel_id, "offset": 0, "kind": "user", "after": 0, "counts": {kind: 0 for kind in TABLES}}
+        header = {"type": "header", "format": FORMAT, "schema": version, "channel_id": channel_id}
+        lines = [json.dumps(header, separators=(",", ":")) + "\n"]
+    else:
+        lines = []
+
+    kinds = list(TABLES)
+
+    # Everything after the last checkpoint is rewritten, a gzip member per chunk keeps the cut clean
+    with open(path, "r+b" if checkpoint["offset"] else "wb") as out:
+        out.truncate(checkpoint["offset"])
+        out.seek(checkpoint["offset"])
+
+        def write_chunk():
+            data = "".join(lines).encode()
+            if compress:
+                data = gzip.compress(data, compresslevel=6, mtime=0)
+            out.write(data)
+            out.flush()
+            os.fsync(out.fileno())
+            checkpoint["offset"] = out.tell()
+            write_checkpoint(path, checkpoint)
+            lines.clear()
+
+        # One read transaction, the export is a snapshot of the database
+        if checkpoint["kind"] != "end":
+            db.execute("BEGIN")
+            for kind in kinds[kinds.index(checkpoint["kind"]):]:
+                if kind != checkpoint["kind"]:
+                    checkpoint["kind"], checkpoint["after"] = kind, 0
+
+                sql, params = export_query(kind, channel_id, checkpoint["after"])
+                columns = TABLES[kind][1]
+                cursor = db.execute(sql, params)
+                while True:
+                    rows = cursor.fetchmany(EXPORT_CHUNK)
+                    if not rows:
+                        break
+                    for row in rows:
+                        record = {"type": kind}
+                        record.update(zip(columns, row))
+                        lines.append(json.dumps(record, separators=(",", ":")) + "\n")
+                    checkpoint["after"] = rows[-1][0]
+                    checkpoint["counts"][kind] += len(rows)
+                    write_chunk()
+            db.execute("COMMIT")
+
+            checkpoint["kind"] = "end"
+            lines.append(json.dumps({"type": "end", "counts": checkpoint["counts"]}, separators=(",", ":")) + "\n")
+            write_chunk()
+
+    db.close()
+    os.remove(path + ".checkpoint")
+    return checkpoint["counts"]
+
+
+def deferred_schema(db):
+    """Return (type, name, sql) of the triggers and indexes of members and messages an import drops.
+
+    Unique indexes stay, INSERT OR IGNORE needs them to skip rows that are
+    already there.
+    """
+
+    return [
+        (kind, name, sql)
+        for kind, name, sql in db.execute("SELECT type, name, sql FROM sqlite_master WHERE tbl_name IN ('members', 'messages') AND type IN ('index', 'trigger') AND sql IS NOT NULL").fetchall()
+        if not sql.upper().startswith("CREATE UNIQUE")
+    ]
+
+
+def restore_schema(db, deferred, channel_ids):
+    """Recreate the deferred indexes and triggers, then rebuild what they would have kept up to date"""
+
+    for kind, name, sql in deferred:
+        if db.execute("SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?", (kind, name)).fetchone() is None:
+            db.execute(sql)
+
+    db.executemany(
+        "UPDATE channels SET "
+        "member_count = (SELECT COUNT(*) FROM members WHERE members.channel_id = channels.id), "
+        "message_count = (SELECT COUNT(*) FROM messages WHERE messages.channel_id = channels.id), "
+        "last_message_id = (SELECT COALESCE(MAX(id), 0) FROM messages WHERE messages.channel_id = channels.id) "
+        "WHERE id = ?",
+        [(channel_id,) for channel_id in channel_ids],
+    )
+    db.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+
+def read_lines(path):
+    """Yield the lines of an export, stopping before one that was cut off"""
+
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                if not line.endswith("\n"):
+                    return
+                yield line
+        except EOFError:
+            # Compressed stream cut off in the middle of a chunk
+            return
+
+
+INSERTS = {
+    "user": "INSERT OR IGNORE INTO users (id, username, email, name, hash, profile_url, created_at) VALUES(?, ?, ?, ?, ?, ?, ?)",
+    "channel": "INSERT OR IGNORE INTO channels (id, name, description, created_at, admin_id) VALUES(?, ?, ?, ?, ?)",
+    "member": "INSERT OR IGNORE INTO members (id, created_at, user_id, channel_id, last_read_id, read_count) VALUES(?, ?, ?, ?, ?, ?)",
+    "message": "INSERT OR IGNORE INTO messages (id, created_at, user_id, channel_id, message, is_start_date) VALUES(?, ?, ?, ?, ?, ?)",
+}
+
+
+def import_file(database, path, batch_size=IMPORT_BATCH):
+    """Load an export into `database`, keeping ids and skipping rows it already has.
+
+    Returns the number of rows inserted and whether the file was complete.
+    """
+
+    lines = read_lines(path)
+    header = json.loads(next(lines, "{}"))
+    if header.get("type") != "header" or header.get("format") != FORMAT:
+        sys.exit("%s is not an export of format %d" % (path, FORMAT))
+
+    migrate(database)
+    db = connect(database)
+
+    checkpoint = read_checkpoint(path)
+    if checkpoint is None:
+        checkpoint = {"lines": 1, "inserted": 0, "channel_ids": [], "deferred": deferred_schema(db)}
+
+        # Saved before dropping, a crash in between still knows what to recreate
+        write_checkpoint(path, checkpoint)
+    db.execute("BEGIN IMMEDIATE")
+    for kind, name, _ in checkpoint["deferred"]:
+        db.execute("DROP %s IF EXISTS %s" % (kind.upper(), name))
+    db.execute("COMMIT")
+
+    channel_ids = set(checkpoint["channel_ids"])
+    batches = {kind: [] for kind in TABLES}
+    pending = 0
+    complete = False
+    error = None
+
+    def commit(number):
+        db.execute("BEGIN IMMEDIATE")
+        for kind, rows in batches.items():
+            if rows:
+                checkpoint["inserted"] += db.executemany(INSERTS[kind], rows).rowcount
+                rows.clear()
+        db.execute("COMMIT")
+
+        checkpoint["lines"] = number
+        checkpoint["channel_ids"] = sorted(channel_ids)
+        write_checkpoint(path, checkpoint)
+
+    # Lines up to the checkpoint are committed already, they are only counted
+    number = 1
+    try:
+        for number, line in enumerate(lines, 2):
+            if number <= checkpoint["lines"]:
+                continue
+
+            record = json.loads(line)
+            kind = record["type"]
+            if kind == "end":
+                complete = True
+                continue
+            if kind not in TABLES:
+                raise ValueError("unknown record type %r" % kind)
+
+            batches[kind].append(tuple(record.get(column) for column in TABLES[kind][1]))
+            if kind != "user":
+                channel_ids.add(record["id"] if kind == "channel" else record["channel_id"])
+            pending += 1
+            if pending >= batch_size:
+                commit(number)
+                pending = 0
+    except (ValueError, KeyError) as e:
+        # Keep what was read before the broken line, the indexes still have to come back
+        error = "%s:%d: %s" % (path, number, e)
+        number -= 1
+    commit(number)
+
+    # Building the indexes once is much faster than keeping them up to date row by row
+    db.execute("BEGIN IMMEDIATE")
+    restore_schema(db, checkpoint["deferred"], sorted(channel_ids))
+    db.execute("COMMIT")
+    db.execute("PRAGMA optimize")
+    db.close()
+
+    os.remove(path + ".checkpoint")
+    if error:
+        sys.exit(error)
+    return checkpoint["inserted"], complete
+
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Export chat history to NDJSON and import it back")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("file", help="NDJSON file, gzip compressed when it ends in .gz")
+    parser.add_argument("--database", default=os.getenv("DATABASE"), help="defaults to $DATABASE")
+    parser.add_argument("--channel", type=int, help="export only this channel, its members and their users")
+    parser.add_argument("--batch", type=int, default=IMPORT_BATCH, help="lines imported per transaction")
+    options = parser.parse_args()
+
+    if not options.database:
+        sys.exit("no database, set $DATABASE or pass --database")
+
+    if options.command == "export":
+        counts = export_file(options.database, options.file, options.channel)
+        print("Exported " + ", ".join("%d %ss" % (counts[kind], kind) for kind in TABLES))
+    else:
+        inserted, complete = import_file(options.database, options.file, options.batch)
+        print("Imported %d rows" % inserted)
+        if not complete:
+            sys.exit("%s ended before its last line, finish the export and import it again" % options.file)
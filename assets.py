@@ -0,0 +1,151 @@
+import gzip
+import hashlib
+import os
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Types worth compressing, images and fonts are already compressed
+COMPRESSIBLE_TYPES = {
+    "text/html",
+    "text/css",
+    "text/plain",
+    "text/javascript",
+    "application/javascript",
+    "application/json",
+    "image/svg+xml",
+    "image/x-icon",
+    "image/vnd.microsoft.icon",
+}
+
+# Bodies smaller than this fit in a packet or two anyway
+MIN_SIZE = 500
+
+
+class StaticVersions:
+    """Content hashes of static files, used to fingerprint their URLs.
+
+    A hash is recomputed only when the file's modification time changes, so
+    building a URL costs a stat call.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        """Return a short content hash of `filename`, or None if it doesn't exist"""
+
+        path = os.path.join(self.folder, filename)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+
+        with self._lock:
+            cached = self._versions.get(filename)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+
+        with open(path, "rb") as file:
+            version = hashlib.sha1(file.read()).hexdigest()[:12]
+
+        with self._lock:
+            self._versions[filename] = (mtime, version)
+        return version
+
+
+class Compressor:
+    """Compress responses with brotli or gzip, whichever the client prefers.
+
+    Brotli is used only when the optional `brotli` package is installed. Static
+    files are compressed once per content and encoding and served from memory
+    afterwards.
+    """
+
+    def __init__(self, level=6, cache_size=256):
+        self.level = level
+        self.cache_size = cache_size
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def choose_encoding(self, accept_encodings):
+        """Pick a content coding from a werkzeug Accept-Encoding header"""
+
+        if brotli is not None and accept_encodings["br"]:
+            return "br"
+        if accept_encodings["gzip"]:
+            return "gzip"
+        return None
+
+    def compress(self, data, encoding):
+        if encoding == "br":
+            return brotli.compress(data, quality=self.level - 1)
+        return gzip.compress(data, compresslevel=self.level, mtime=0)
+
+    def discard_body(self, response):
+        """Close an unread passthrough body before replacing it"""
+
+        if hasattr(response.response, "close"):
+            response.response.close()
+        response.direct_passthrough = False
+
+    def __call__(self, request, response):
+        """Compress `response` in place when it's worth it, and return it"""
+
+        response.vary.add("Accept-Encoding")
+
+        if (
+            response.status_code != 200
+            or response.is_streamed and not response.direct_passthrough
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES
+            or request.method == "HEAD"
+        ):
+            return response
+
+        encoding = self.choose_encoding(request.accept_encodings)
+        if encoding is None:
+            return response
+
+        # A strong validator must change with the representation, so the
+        # client revalidates with the suffixed tag the view doesn't know about
+        etag, _ = response.get_etag()
+        if etag:
+            encoded_etag = "%s-%s" % (etag, encoding)
+            if request.if_none_match.contains(encoded_etag):
+                self.discard_body(response)
+                response.set_data(b"")
+                response.status_code = 304
+                response.set_etag(encoded_etag)
+                return response
+
+        # Static files are sent as passthrough file wrappers, compress them once
+        key = (request.path, etag, encoding) if response.direct_passthrough and etag else None
+        with self._lock:
+            body = self._cache.get(key) if key else None
+
+        if body is None:
+            response.direct_passthrough = False
+            data = response.get_data()
+            if len(data) < MIN_SIZE:
+                return response
+
+            body = self.compress(data, encoding)
+            if key:
+                with self._lock:
+                    if len(self._cache) >= self.cache_size:
+                        self._cache.clear()
+                    self._cache[key] = body
+        else:
+            self.discard_body(response)
+
+        response.set_data(body)
+        response.headers["Content-Encoding"] = encoding
+        if etag:
+            response.set_etag(encoded_etag)
+        return response
@@ -0,0 +1,127 @@
+"""Minimal blocking HTTP and Socket.IO (Engine.IO v4 long-polling) client for benchmarks.
+
+It only needs the standard library, so the benchmarks run without extra packages
+or network access.
+"""
+
+import http.client
+import json
+import threading
+import time
+import urllib.parse
+
+SEPARATOR = "\x1e"
+
+
+class HTTPClient:
+    """Keep-alive HTTP client that remembers the session cookie"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.cookie = None
+        self.conn = http.client.HTTPConnection(host, port, timeout=60)
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        if isinstance(body, dict):
+            body = urllib.parse.urlencode(body)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+        self.conn.request(method, path, body=body, headers=headers)
+        response = self.conn.getresponse()
+        data = response.read()
+
+        cookie = response.getheader("Set-Cookie")
+        if cookie:
+            self.cookie = cookie.split(";", 1)[0]
+        return response.status, response.headers, data
+
+    def login(self, username, password):
+        status, _, _ = self.request("POST", "/login", {"username": username, "password": password})
+        if status != 302:
+            raise RuntimeError("login failed for %s with status %d" % (username, status))
+
+
+class SocketClient:
+    """Socket.IO client on the long-polling transport, events are handed to `on_event`"""
+
+    def __init__(self, host, port, cookie, on_event=None):
+        self.host = host
+        self.port = port
+        self.cookie = cookie
+        self.on_event = on_event
+        self.sid = None
+        self.connected = threading.Event()
+        self._send_conn = http.client.HTTPConnection(host, port, timeout=60)
+        self._poll_conn = http.client.HTTPConnection(host, port, timeout=60)
+        self._send_lock = threading.Lock()
+        self._thread = None
+        self._running = False
+
+    def _url(self):
+        url = "/socket.io/?EIO=4&transport=polling&t=%d" % (time.time() * 1000)
+        if self.sid:
+            url += "&sid=" + self.sid
+        return url
+
+    def _get(self):
+        self._poll_conn.request("GET", self._url(), headers={"Cookie": self.cookie})
+        response = self._poll_conn.getresponse()
+        data = response.read().decode()
+        if response.status != 200:
+            raise RuntimeError("poll failed with status %d: %s" % (response.status, data))
+        return data.split(SEPARATOR) if data else []
+
+    def _post(self, packet):
+        with self._send_lock:
+            self._send_conn.request("POST", self._url(), body=packet.encode(), headers={"Cookie": self.cookie, "Content-Type": "text/plain;charset=UTF-8"})
+            response = self._send_conn.getresponse()
+            response.read()
+            if response.status != 200:
+                raise RuntimeError("send failed with status %d" % response.status)
+
+    def connect(self):
+        """Open the Engine.IO session, join the default namespace and start polling"""
+
+        handshake = self._get()[0]
+        self.sid = json.loads(handshake[1:])["sid"]
+        self._post("40")
+
+        self._running = True
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+        self._thread.start()
+        if not self.connected.wait(30):
+            raise RuntimeError("namespace connection timed out")
+
+    def emit(self, event, *args):
+        self._post("42" + json.dumps([event] + list(args)))
+
+    def close(self):
+        self._running = False
+        try:
+            self._post("1")
+        except Exception:
+            pass
+
+    def _poll(self):
+        while self._running:
+            try:
+                packets = self._get()
+            except Exception:
+                if self._running:
+                    raise
+                return
+
+            for packet in packets:
+                if packet == "2":
+                    self._post("3")
+                elif packet.startswith("40"):
+                    self.connected.set()
+                elif packet.startswith("42") and self.on_event:
+                    payload = json.loads(packet[2:])
+                    self.on_event(payload[0], payload[1:])
+                elif packet == "1":
+                    return
@@ -0,0 +1,171 @@
+"""Load test Socket.IO broadcast fan-out across worker processes sharing a message queue.
+
+Starts `workers` app processes on consecutive ports, all pointing
+SOCKETIO_MESSAGE_QUEUE at one local Unix socket queue, connects `clients`
+sockets to the same channel on every worker and has each worker's users send
+`messages` chat lines. Every socket must receive the lines sent on all workers.
+
+Set MESSAGE_COALESCE=true to receive the lines in messages_batch events.
+
+Usage: python benchmarks/fanout.py [workers] [clients] [messages]
+"""
+
+import multiprocessing
+import os
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.client import HTTPClient, SocketClient
+
+HOST = "127.0.0.1"
+BASE_PORT = 5600
+PASSWORD = "benchmark1!"
+TIMEOUT = 60
+
+
+def seed(database, users):
+    """Create the database with the benchmark users"""
+
+    from werkzeug.security import generate_password_hash
+    from migrate import migrate
+
+    migrate(database)
+    db = sqlite3.connect(database)
+    password_hash = generate_password_hash(PASSWORD)
+    db.executemany(
+        "INSERT INTO users (username, email, name, hash) VALUES(?, ?, ?, ?)",
+        [("bench%d" % index, "bench%d@localhost" % index, "Bench %d" % index, password_hash) for index in range(users)],
+    )
+    db.commit()
+    db.close()
+
+
+def serve(workdir, port):
+    """Run one app worker"""
+
+    os.chdir(workdir)
+    from app import app, socketio
+
+    socketio.run(app, host=HOST, port=port, log_output=False)
+
+
+def wait_for_port(port):
+    deadline = time.monotonic() + TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("worker on port %d did not start" % port)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+    messages = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    expected = workers * messages
+
+    received = {}
+    frames = [0]
+    lags = []
+    lock = threading.Lock()
+
+    def on_event(key):
+        def handler(event, args):
+            if event == "new_message":
+                batch = [args[0]]
+            elif event == "messages_batch":
+                batch = args[0]
+            else:
+                return
+
+            # Messages arrive as positional arrays, the text is the fifth field
+            now = time.time()
+            with lock:
+                frames[0] += 1
+                for message in batch:
+                    received[key] += 1
+                    lags.append(now - float(message[4].rsplit("sent_at=", 1)[1]))
+
+        return handler
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.environ["DATABASE"] = os.path.join(workdir, "chat_group.db")
+        os.environ["SOCKETIO_MESSAGE_QUEUE"] = "unix://" + os.path.join(workdir, "mq")
+        os.environ.setdefault("TIMEZONE", "UTC")
+        seed(os.environ["DATABASE"], workers * clients)
+
+        context = multiprocessing.get_context("spawn")
+        processes = [context.Process(target=serve, args=(workdir, BASE_PORT + index), daemon=True) for index in range(workers)]
+        for process in processes:
+            process.start()
+
+        try:
+            sockets = []
+            for worker in range(workers):
+                port = BASE_PORT + worker
+                wait_for_port(port)
+
+                for number in range(clients):
+                    user = worker * clients + number
+                    http = HTTPClient(HOST, port)
+                    http.login("bench%d" % user, PASSWORD)
+                    http.request("GET", "/channel/1")
+
+                    received[user] = 0
+                    sock = SocketClient(HOST, port, http.cookie, on_event(user))
+                    sock.connect()
+                    sock.emit("reset_room")
+                    sockets.append((worker, sock))
+
+            # Give every socket time to join the room before sending
+            time.sleep(1)
+
+            def send(sock, worker):
+                for number in range(messages):
+                    sock.emit("new_message", "worker %d message %d sent_at=%f" % (worker, number, time.time()))
+
+            start = time.perf_counter()
+            senders = [threading.Thread(target=send, args=(sock, worker)) for worker, sock in sockets[::clients]]
+            for sender in senders:
+                sender.start()
+
+            deadline = time.monotonic() + TIMEOUT
+            while min(received.values()) < expected and time.monotonic() < deadline:
+                time.sleep(0.05)
+            elapsed = time.perf_counter() - start
+
+            for _, sock in sockets:
+                sock.close()
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+
+    delivered = sum(received.values())
+    print("%d workers x %d sockets, %d messages per worker" % (workers, clients, messages))
+    print("delivered %d of %d in %.2fs (%.0f/s)" % (delivered, expected * len(received), elapsed, delivered / elapsed))
+    print("in %d events, %.1f messages per event" % (frames[0], delivered / max(frames[0], 1)))
+    if lags:
+        print("delivery lag p50 %.1f ms, p99 %.1f ms" % (percentile(lags, 0.5) * 1000, percentile(lags, 0.99) * 1000))
+
+    if any(count != expected for count in received.values()):
+        sys.exit("expected every socket to receive exactly %d messages, got %d to %d" % (expected, min(received.values()), max(received.values())))
+    print("every socket received all %d messages" % expected)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Compare per-row and batched formatting of message timestamps.
+
+Usage: python benchmarks/formatting.py [pages]
+"""
+
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("TIMEZONE", "Asia/Jakarta")
+
+from helpers import format_messages
+
+PAGE_SIZE = 50
+
+
+def format_message_date_per_row(iso_date):
+    """Formatting as every route used to do it, once per row"""
+
+    dt_object = datetime.fromisoformat(iso_date)
+    dt_object = dt_object.replace(tzinfo=pytz.utc).astimezone(pytz.timezone(os.getenv("TIMEZONE")))
+
+    if dt_object.date() == datetime.now().date():
+        return "today at " + dt_object.strftime("%I:%M %p")
+    elif dt_object.date() == datetime.now().date() - timedelta(days=1):
+        return "yesterday at " + dt_object.strftime("%I:%M %p")
+    else:
+        return dt_object.strftime("%m/%d/%Y %I:%M %p")
+
+
+def format_per_row(messages):
+    for message in messages:
+        if message["is_start_date"]:
+            message["start_date_at"] = datetime.fromisoformat(message["created_at"]).strftime("%B %d, %Y")
+
+        message["created_at"] = format_message_date_per_row(message["created_at"])
+    return messages
+
+
+def make_pages(count):
+    """Build `count` pages of rows spread over the last few days, one message a minute"""
+
+    now = datetime.utcnow()
+    pages = []
+    for page in range(count):
+        rows = []
+        for number in range(PAGE_SIZE):
+            created_at = now - timedelta(minutes=page * PAGE_SIZE + number)
+            rows.append({"created_at": created_at.strftime("%Y-%m-%d %H:%M:%S"), "is_start_date": number == 0})
+        pages.append(rows)
+    return pages
+
+
+def run(formatter, pages):
+    copies = [[dict(row) for row in page] for page in pages]
+    start = time.perf_counter()
+    for page in copies:
+        formatter(page)
+    return (time.perf_counter() - start) / len(copies) * 1e6
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    pages = make_pages(count)
+
+    before = run(format_per_row, pages)
+    cold = run(format_messages, pages)
+    warm = run(format_messages, pages)
+
+    print("%d pages of %d messages" % (count, PAGE_SIZE))
+    print("per-row formatting:      %8.1f us/page" % before)
+    print("batched, first render:   %8.1f us/page" % cold)
+    print("batched, repeat render:  %8.1f us/page" % warm)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""Load test the HTTP hot paths and Socket.IO broadcasts of app workers on this machine.
+
+Seeds a database (or reuses one given with --database), starts --workers app
+processes and runs two phases against them, with no network access needed:
+
+- HTTP: --clients logged-in users each send --requests requests, cycling
+  through /, /channel/<id>, /messages and /channel/search.
+- Socket: --receivers sockets per worker follow the General channel while
+  one sender per worker sends --socket-messages chat lines.
+
+It reports p50/p99 latency and throughput per route, and the broadcast delivery
+lag. Pass --json to also write the numbers to a file for comparison between runs.
+The exit status is non-zero when a request fails or a broadcast is lost.
+
+Usage: python benchmarks/load.py [--users N] [--channels N] [--messages N] [--workers N] ...
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.client import HTTPClient, SocketClient
+from benchmarks.fanout import HOST, BASE_PORT, TIMEOUT, serve, wait_for_port, percentile
+from benchmarks.seed import PASSWORD, WORDS, seed
+
+ROUTES = ["home", "channel", "messages", "search"]
+
+
+def summarize(latencies, elapsed):
+    return {
+        "requests": len(latencies),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "per_second": round(len(latencies) / elapsed, 1),
+    }
+
+
+def run_http(options, channel_ids):
+    """Drive the page and JSON routes from `clients` threads, returning per-route results"""
+
+    latencies = {route: [] for route in ROUTES}
+    errors = []
+    lock = threading.Lock()
+
+    def client(index):
+        rng = random.Random(index)
+        port = BASE_PORT + index % options.workers
+        http = HTTPClient(HOST, port)
+        http.login("bench%d" % index, PASSWORD)
+
+        for number in range(options.requests):
+            route = ROUTES[number % len(ROUTES)]
+            if route == "home":
+                path = "/"
+            elif route == "channel":
+                # Everyone is a member of General, other channels are joined on the first visit
+                path = "/channel/%d" % rng.choice(channel_ids)
+            elif route == "messages":
+                path = "/messages?pageSize=20&before=%d" % rng.randint(2, options.messages + 1)
+            else:
+                path = "/channel/search?name=%s" % rng.choice(["bench", "channel", "general", "1", "2"])
+
+            start = time.perf_counter()
+            status, _, _ = http.request("GET", path)
+            latency = time.perf_counter() - start
+
+            with lock:
+                if status != 200:
+                    errors.append("%s -> %d" % (path, status))
+                latencies[route].append(latency)
+
+    threads = [threading.Thread(target=client, args=(index,)) for index in range(options.clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    results = {route: summarize(values, elapsed) for route, values in latencies.items() if values}
+    results["all"] = summarize([value for values in latencies.values() for value in values], elapsed)
+    return results, errors
+
+
+def run_sockets(options):
+    """Broadcast chat lines from one sender per worker to every receiver, returning delivery results"""
+
+    expected = options.workers * options.socket_messages
+    received = {}
+    lags = []
+    lock = threading.Lock()
+
+    def on_event(key):
+        def handler(event, args):
+            if event == "new_message":
+                batch = [args[0]]
+            elif event == "messages_batch":
+                batch = args[0]
+            else:
+                return
+
+            # Messages arrive as positional arrays, the text is the fifth field
+            now = time.time()
+            with lock:
+                for message in batch:
+                    if "sent_at=" in message[4]:
+                        received[key] += 1
+                        lags.append(now - float(message[4].rsplit("sent_at=", 1)[1]))
+
+        return handler
+
+    sockets = []
+    for worker in range(options.workers):
+        port = BASE_PORT + worker
+        for number in range(options.receivers):
+            user = worker * options.receivers + number
+            http = HTTPClient(HOST, port)
+            http.login("bench%d" % user, PASSWORD)
+
+            received[user] = 0
+            sock = SocketClient(HOST, port, http.cookie, on_event(user))
+            sock.connect()
+            sock.emit("join_channel", 1)
+            sockets.append((worker, sock))
+
+    # Give every socket time to join the room before sending
+    time.sleep(1)
+
+    def send(sock, worker):
+        for number in range(options.socket_messages):
+            sock.emit("new_message", {"channel_id": 1, "message": "%s worker %d message %d sent_at=%f" % (random.choice(WORDS), worker, number, time.time())})
+
+    start = time.perf_counter()
+    senders = [threading.Thread(target=send, args=(sock, worker)) for worker, sock in sockets[::options.receivers]]
+    for sender in senders:
+        sender.start()
+
+    deadline = time.monotonic() + TIMEOUT
+    while min(received.values()) < expected and time.monotonic() < deadline:
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    for _, sock in sockets:
+        sock.close()
+
+    delivered = sum(received.values())
+    results = {
+        "sockets": len(sockets),
+        "expected": expected * len(sockets),
+        "delivered": delivered,
+        "per_second": round(delivered / elapsed, 1),
+        "lag_p50_ms": round(percentile(lags, 0.5) * 1000, 2) if lags else None,
+        "lag_p99_ms": round(percentile(lags, 0.99) * 1000, 2) if lags else None,
+    }
+    return results, delivered != expected * len(sockets)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", 1)[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--database", help="reuse or create the seeded database at this path")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200, help="requests per HTTP client")
+    parser.add_argument("--receivers", type=int, default=25, help="sockets per worker")
+    parser.add_argument("--socket-messages", type=int, default=100, help="chat lines sent per worker")
+    parser.add_argument("--json", help="also write the results to this file")
+    options = parser.parse_args()
+
+    if options.clients > options.users or options.workers * options.receivers > options.users:
+        parser.error("--users must cover every HTTP client and socket")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        database = options.database or os.path.join(workdir, "chat_group.db")
+        if not os.path.exists(database):
+            start = time.perf_counter()
+            seed(database, options.users, options.channels, options.messages)
+            print("seeded %d users, %d channels and %d messages in %.1fs" % (options.users, options.channels, options.messages, time.perf_counter() - start))
+
+        os.environ["DATABASE"] = os.path.abspath(database)
+        os.environ["SOCKETIO_MESSAGE_QUEUE"] = "unix://" + os.path.join(workdir, "mq")
+        os.environ.setdefault("TIMEZONE", "UTC")
+        os.environ.setdefault("PROFILE_STORAGE", "local")
+
+        import sqlite3
+        db = sqlite3.connect(database)
+        channel_ids = [row[0] for row in db.execute("SELECT id FROM channels ORDER BY id LIMIT ?", (options.channels,))]
+        db.close()
+
+        context = multiprocessing.get_context("spawn")
+        processes = [context.Process(target=serve, args=(workdir, BASE_PORT + index), daemon=True) for index in range(options.workers)]
+        for process in processes:
+            process.start()
+
+        try:
+            for index in range(options.workers):
+                wait_for_port(BASE_PORT + index)
+
+            http_results, errors = run_http(options, channel_ids)
+            socket_results, lost = run_sockets(options)
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+
+    print("%d workers, %d HTTP clients x %d requests" % (options.workers, options.clients, options.requests))
+    print("%-10s %9s %9s %9s %9s" % ("route", "requests", "p50 ms", "p99 ms", "req/s"))
+    for route, result in http_results.items():
+        print("%-10s %9d %9.2f %9.2f %9.1f" % (route, result["requests"], result["p50_ms"], result["p99_ms"], result["per_second"]))
+
+    print("%d sockets, %d chat lines per worker" % (socket_results["sockets"], options.socket_messages))
+    print("delivered %d of %d (%.0f/s), lag p50 %s ms, p99 %s ms" % (
+        socket_results["delivered"], socket_results["expected"], socket_results["per_second"],
+        socket_results["lag_p50_ms"], socket_results["lag_p99_ms"],
+    ))
+
+    if options.json:
+        with open(options.json, "w") as file:
+            json.dump({"options": vars(options), "http": http_results, "sockets": socket_results}, file, indent=2)
+
+    if errors:
+        sys.exit("%d requests failed, first: %s" % (len(errors), errors[0]))
+    if lost:
+        sys.exit("broadcasts were lost")
+
+
+if __name__ == "__main__":
+    main()
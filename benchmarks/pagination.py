@@ -0,0 +1,85 @@
+"""Compare OFFSET and cursor pagination of channel history.
+
+Usage: python benchmarks/pagination.py [messages] [page_size]
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGES = [1, 10, 100, 1000, 10000]
+RUNS = 20
+
+OFFSET_QUERY = """
+    SELECT messages.id, users.name, users.profile_url, messages.message, messages.created_at, messages.is_start_date FROM messages
+    JOIN users ON messages.user_id = users.id
+    WHERE messages.channel_id = ?
+    ORDER BY messages.id DESC
+    LIMIT ? OFFSET ?
+"""
+
+CURSOR_QUERY = """
+    SELECT messages.id, users.name, users.profile_url, messages.message, messages.created_at, messages.is_start_date FROM messages
+    JOIN users ON messages.user_id = users.id
+    WHERE messages.channel_id = ? AND messages.id < ?
+    ORDER BY messages.id DESC
+    LIMIT ?
+"""
+
+
+def seed(db, count):
+    """Fill channel 1 with `count` messages, interleaved with traffic in channel 2"""
+
+    with open(os.path.join(ROOT, "init.sql")) as f:
+        db.executescript(f.read())
+
+    db.execute("INSERT INTO channels (name, admin_id, description) VALUES ('Noise', 1, 'Other traffic')")
+    rows = ((1 + i % 3 // 2, 1, "message %d" % i) for i in range(count + count // 2))
+    db.executemany("INSERT INTO messages (channel_id, user_id, message) VALUES (?, ?, ?)", rows)
+    db.commit()
+
+
+def measure(db, query, params):
+    """Return the median latency of a query in milliseconds"""
+
+    timings = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        db.execute(query, params).fetchall()
+        timings.append((time.perf_counter() - start) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    page_size = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = sqlite3.connect(os.path.join(tmp, "bench.db"))
+
+        print("Seeding %d messages..." % count)
+        seed(db, count)
+
+        print("%8s %12s %12s" % ("page", "offset ms", "cursor ms"))
+        for page in PAGES:
+            offset = (page - 1) * page_size
+
+            # Cursor a client would hold after scrolling to this page
+            before = db.execute(
+                "SELECT id FROM messages WHERE channel_id = 1 ORDER BY id DESC LIMIT 1 OFFSET ?", (offset - 1,)
+            ).fetchone() if page > 1 else (sys.maxsize,)
+            if before is None:
+                break
+
+            offset_ms = measure(db, OFFSET_QUERY, (1, page_size, offset))
+            cursor_ms = measure(db, CURSOR_QUERY, (1, before[0], page_size))
+            print("%8d %12.3f %12.3f" % (page, offset_ms, cursor_ms))
+
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Seed a chat database at benchmark scale.
+
+Users are named bench0, bench1, ... and share PASSWORD. Every user is a
+member of the General channel (id 1), and each other channel gets a slice of
+the users. Messages are spread round-robin over the channels, one a minute
+going back from now, so pages cover several days.
+
+Usage: python benchmarks/seed.py database [users] [channels] [messages]
+"""
+
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = "benchmark1!"
+CHUNK = 50000
+WORDS = ["hello", "deploy", "review", "lunch", "standup", "bug", "release", "coffee", "meeting", "search", "socket", "cache"]
+
+
+def chunks(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def seed(database, users=100, channels=10, messages=10000, random_seed=0):
+    """Create the database and fill it with `users`, `channels` and `messages` rows"""
+
+    from werkzeug.security import generate_password_hash
+    from migrate import migrate
+
+    migrate(database)
+    random.seed(random_seed)
+    db = sqlite3.connect(database)
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("PRAGMA synchronous = OFF")
+
+    password_hash = generate_password_hash(PASSWORD)
+    first_user = db.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM users").fetchone()[0]
+    db.executemany(
+        "INSERT INTO users (username, email, name, hash) VALUES(?, ?, ?, ?)",
+        (("bench%d" % index, "bench%d@localhost" % index, "Bench User %d" % index, password_hash) for index in range(users)),
+    )
+    user_ids = list(range(first_user, first_user + users))
+
+    db.executemany(
+        "INSERT INTO channels (name, description, admin_id) VALUES(?, ?, ?)",
+        (("bench channel %d" % index, "Benchmark channel number %d" % index, user_ids[0]) for index in range(1, channels)),
+    )
+    channel_ids = [row[0] for row in db.execute("SELECT id FROM channels ORDER BY id").fetchall()[:channels]]
+
+    # Everyone is in General, other channels get a tenth of the users each
+    slice_size = max(1, users // 10)
+    members = [(user_id, channel_ids[0]) for user_id in user_ids]
+    for channel_id in channel_ids[1:]:
+        members += [(user_id, channel_id) for user_id in random.sample(user_ids, min(slice_size, users))]
+    db.executemany("INSERT OR IGNORE INTO members (user_id, channel_id) VALUES(?, ?)", members)
+    db.commit()
+
+    # Oldest first so ids follow created_at, the first message of each day starts a date divider
+    now = datetime.utcnow().replace(microsecond=0)
+    last_day = {}
+
+    def rows():
+        for number in range(messages):
+            created_at = now - timedelta(minutes=messages - number)
+            channel_id = channel_ids[number % len(channel_ids)]
+            is_start_date = last_day.get(channel_id) != created_at.date()
+            last_day[channel_id] = created_at.date()
+            text = " ".join(random.choice(WORDS) for _ in range(6)) + " %d" % number
+            yield (random.choice(user_ids), channel_id, text, is_start_date, created_at.strftime("%Y-%m-%d %H:%M:%S"))
+
+    for chunk in chunks(rows()):
+        db.executemany("INSERT INTO messages (user_id, channel_id, message, is_start_date, created_at) VALUES(?, ?, ?, ?, ?)", chunk)
+        db.commit()
+
+    db.execute("PRAGMA optimize")
+    db.close()
+    return channel_ids
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+
+    database = sys.argv[1]
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    channels = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    messages = int(sys.argv[4]) if len(sys.argv) > 4 else 10000
+
+    start = time.perf_counter()
+    seed(database, users, channels, messages)
+    print("seeded %d users, %d channels and %d messages in %.1fs" % (users, channels, messages, time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
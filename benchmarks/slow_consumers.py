@@ -0,0 +1,207 @@
+"""Check that clients which stop reading can't grow server memory without bound.
+
+Starts one app worker, opens --clients websocket connections that follow the
+General channel and then never read again, plus one fast polling receiver,
+and sends --messages chat lines of --size characters to the room. The worker's
+resident memory is sampled as the lines go out.
+
+With the default send queue limit the memory must stay flat over the second
+half of the run (within --max-growth MB) and the fast receiver must still get
+every line, otherwise the exit status is non-zero. Pass --limit 0 to see the
+unbounded growth this guards against. Keep the run within the Engine.IO ping
+timeout of about 45 seconds, after that the worker drops the silent sockets by
+itself. Lines must be long enough to fill the kernel socket buffers of the slow
+clients, or nothing ever waits in the send queues.
+
+Usage: python benchmarks/slow_consumers.py [--clients N] [--messages N] [--limit N] [--policy resync|disconnect]
+"""
+
+import argparse
+import base64
+import multiprocessing
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.client import HTTPClient, SocketClient
+from benchmarks.fanout import HOST, BASE_PORT, TIMEOUT, wait_for_port
+from benchmarks.seed import PASSWORD, seed
+
+
+def serve(workdir, port, connections):
+    """Run one app worker that accepts `connections` at once, eventlet stops at 1024 by default"""
+
+    os.chdir(workdir)
+    from app import app, socketio
+
+    socketio.run(app, host=HOST, port=port, log_output=False, max_size=connections)
+
+
+def text_frame(text):
+    """Encode a masked websocket text frame, as clients must send them"""
+
+    payload = text.encode()
+    mask = os.urandom(4)
+    if len(payload) < 126:
+        header = struct.pack("!BB", 0x81, 0x80 | len(payload))
+    else:
+        header = struct.pack("!BBH", 0x81, 0x80 | 126, len(payload))
+    return header + mask + bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+
+
+def open_slow_socket(port, cookie):
+    """Connect over websocket, follow General and never read again"""
+
+    sock = socket.socket()
+    # A tiny receive window fills up after a few frames
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.connect((HOST, port))
+
+    key = base64.b64encode(os.urandom(16)).decode()
+    sock.sendall(((
+        "GET /socket.io/?EIO=4&transport=websocket HTTP/1.1\r\n"
+        "Host: %s:%d\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+        "Sec-WebSocket-Key: %s\r\nSec-WebSocket-Version: 13\r\nCookie: %s\r\n\r\n"
+    ) % (HOST, port, key, cookie)).encode())
+
+    response = b""
+    while b"\r\n\r\n" not in response:
+        response += sock.recv(4096)
+    if not response.startswith(b"HTTP/1.1 101"):
+        raise RuntimeError("websocket upgrade failed: %r" % response[:100])
+
+    sock.sendall(text_frame("40"))
+    sock.sendall(text_frame('42["join_channel",1]'))
+    return sock
+
+
+def resident_mb(pid):
+    with open("/proc/%d/status" % pid) as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0
+
+
+def scrape(port, name):
+    """Read one unlabeled sample from the worker's /metrics, None when it isn't there"""
+
+    with urllib.request.urlopen("http://%s:%d/metrics" % (HOST, port), timeout=10) as response:
+        for line in response.read().decode().splitlines():
+            if line.startswith(name + " "):
+                return float(line.split()[1])
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", 1)[0])
+    parser.add_argument("--clients", type=int, default=2000, help="slow websocket clients in the room")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--size", type=int, default=2048, help="characters per chat line")
+    parser.add_argument("--limit", type=int, default=1000, help="SOCKET_SEND_QUEUE_LIMIT of the worker, 0 for none")
+    parser.add_argument("--policy", default="resync", choices=["resync", "disconnect"])
+    parser.add_argument("--max-growth", type=float, default=10, help="MB the worker may grow over the second half")
+    options = parser.parse_args()
+
+    port = BASE_PORT
+    with tempfile.TemporaryDirectory() as workdir:
+        database = os.path.join(workdir, "chat_group.db")
+        seed(database, users=2, channels=1, messages=0)
+
+        os.environ["DATABASE"] = database
+        os.environ["SOCKET_SEND_QUEUE_LIMIT"] = str(options.limit)
+        os.environ["SLOW_CONSUMER_POLICY"] = options.policy
+        os.environ.setdefault("TIMEZONE", "UTC")
+        os.environ.setdefault("PROFILE_STORAGE", "local")
+
+        context = multiprocessing.get_context("spawn")
+        process = context.Process(target=serve, args=(workdir, port, options.clients + 100), daemon=True)
+        process.start()
+
+        slow = []
+        try:
+            wait_for_port(port)
+
+            http = HTTPClient(HOST, port)
+            http.login("bench0", PASSWORD)
+
+            # In parallel, the sockets opened first must not hit the ping timeout before sending ends
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=50) as executor:
+                slow.extend(executor.map(lambda _: open_slow_socket(port, http.cookie), range(options.clients)))
+            print("opened %d slow sockets in %.1fs" % (len(slow), time.perf_counter() - start))
+
+            received = []
+            resyncs = []
+            done = threading.Event()
+
+            def on_event(event, args):
+                if event == "resync":
+                    resyncs.append(time.time())
+                elif event == "new_message":
+                    received.append(args[0])
+                elif event == "messages_batch":
+                    received.extend(args[0])
+                if len(received) >= options.messages:
+                    done.set()
+
+            receiver_http = HTTPClient(HOST, port)
+            receiver_http.login("bench1", PASSWORD)
+            receiver = SocketClient(HOST, port, receiver_http.cookie, on_event)
+            receiver.connect()
+            receiver.emit("join_channel", 1)
+
+            sender = SocketClient(HOST, port, http.cookie)
+            sender.connect()
+            sender.emit("join_channel", 1)
+            time.sleep(1)
+
+            baseline = resident_mb(process.pid)
+            samples = []
+            text = "x" * options.size
+            start = time.perf_counter()
+            for number in range(options.messages):
+                sender.emit("new_message", {"channel_id": 1, "message": "%d %s" % (number, text)})
+                if (number + 1) % max(1, options.messages // 10) == 0:
+                    samples.append((number + 1, resident_mb(process.pid)))
+
+            done.wait(TIMEOUT)
+            elapsed = time.perf_counter() - start
+            queued = scrape(port, "chat_socket_send_queue_packets")
+            dropped = scrape(port, "chat_socket_dropped_events_total")
+
+            receiver.close()
+            sender.close()
+        finally:
+            for sock in slow:
+                sock.close()
+            process.terminate()
+            process.join()
+
+    print("limit %s, policy %s, %d lines of %d characters in %.1fs" % (options.limit or "none", options.policy, options.messages, options.size, elapsed))
+    print("%10s %10s" % ("sent", "RSS MB"))
+    print("%10s %10.1f" % ("baseline", baseline))
+    for sent, rss in samples:
+        print("%10d %10.1f" % (sent, rss))
+    print("fast receiver got %d of %d and %d resyncs, %d packets still queued, %d events dropped" % (len(received), options.messages, len(resyncs), queued or 0, dropped or 0))
+
+    growth = samples[-1][1] - samples[len(samples) // 2 - 1][1]
+    print("growth over the second half: %.1f MB" % growth)
+
+    if len(received) < options.messages:
+        sys.exit("the fast receiver missed lines")
+    if options.limit and growth > options.max_growth:
+        sys.exit("memory kept growing with the send queue limit on")
+
+
+if __name__ == "__main__":
+    main()
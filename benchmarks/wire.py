@@ -0,0 +1,93 @@
+"""Compare the CPU cost of broadcasting a chat line as a nested JSON string and as a msgspec struct.
+
+Each broadcast goes through a real Socket.IO server to a room of connected
+clients, up to the point where the Engine.IO packet is handed to the transport.
+Client decoding is approximated with Python's json module.
+
+Usage: python benchmarks/wire.py [recipients] [broadcasts]
+"""
+
+import json
+import os
+import sys
+import time
+
+import socketio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from wire import NewMessage, WireJSON
+
+FIELDS = ["channel_id", "name", "profile_url", "created_at", "message", "start_date_at"]
+
+
+def make_server(recipients, json_module=None):
+    """Return a server with `recipients` clients in room 1 and the list their frames go to"""
+
+    options = {"json": json_module} if json_module else {}
+    server = socketio.Server(async_mode="threading", **options)
+    frames = []
+    server._send_eio_packet = lambda eio_sid, pkt: frames.append(pkt.encode())
+
+    for number in range(recipients):
+        sid = server.manager.connect("eio-%d" % number, "/")
+        server.manager.enter_room(sid, "/", 1)
+    return server, frames
+
+
+def broadcast_json(server, number):
+    data = {
+        "channel_id": 1,
+        "name": "Test User",
+        "profile_url": "https://res.cloudinary.com/demo/image/upload/profile.jpg",
+        "created_at": "today at 09:41 AM",
+        "message": "hello %d" % number,
+    }
+    server.emit("new_message", json.dumps(data), to=1)
+
+
+def broadcast_struct(server, number):
+    data = NewMessage(1, "Test User", "https://res.cloudinary.com/demo/image/upload/profile.jpg", "today at 09:41 AM", "hello %d" % number)
+    server.emit("new_message", data, to=1)
+
+
+def decode_json(frame):
+    return json.loads(json.loads(frame[2:])[1])
+
+
+def decode_struct(frame):
+    return dict(zip(FIELDS, json.loads(frame[2:])[1]))
+
+
+def run(server, frames, broadcast, decode, broadcasts):
+    start = time.perf_counter()
+    for number in range(broadcasts):
+        broadcast(server, number)
+    send = (time.perf_counter() - start) / broadcasts * 1e3
+
+    size = len(frames[0])
+    start = time.perf_counter()
+    for frame in frames[:len(frames) // broadcasts]:
+        decode(frame)
+    receive = (time.perf_counter() - start) * 1e3
+
+    frames.clear()
+    return send, receive, size
+
+
+def main():
+    recipients = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    broadcasts = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    before = run(*make_server(recipients), broadcast_json, decode_json, broadcasts)
+    after = run(*make_server(recipients, WireJSON), broadcast_struct, decode_struct, broadcasts)
+
+    print("%d broadcasts to %d recipients" % (broadcasts, recipients))
+    print("                  server ms/broadcast  client decode ms/broadcast  bytes/frame")
+    print("nested JSON:      %19.3f  %26.3f  %11d" % before)
+    print("msgspec struct:   %19.3f  %26.3f  %11d" % after)
+
+
+if __name__ == "__main__":
+    main()
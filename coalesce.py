@@ -0,0 +1,55 @@
+import threading
+
+
+class Coalescer:
+    """Deliver events to a room in batches instead of one emit per event.
+
+    The first event for a room starts a timer. Events that arrive before it
+    fires, up to `max_batch` of them, are sent together as one `event` whose
+    payload is the list of items, or what `pack` makes of it. A room therefore
+    gets at most one frame per `max_latency` seconds, or an extra one for each
+    full batch.
+    """
+
+    def __init__(self, socketio, event, max_latency=0.02, max_batch=100, pack=None):
+        self.socketio = socketio
+        self.event = event
+        self.pack = pack
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+        self._buffers = {}
+        self._lock = threading.Lock()
+        self.items = 0
+        self.batches = 0
+
+    def add(self, room, item):
+        """Queue an item for a room, sending the batch right away once it's full"""
+
+        with self._lock:
+            buffer = self._buffers.get(room)
+            if buffer is None:
+                buffer = self._buffers[room] = []
+                self.socketio.start_background_task(self._flush_later, room)
+
+            buffer.append(item)
+            self.items += 1
+
+            # Emit under the lock so batches for a room leave in order
+            if len(buffer) >= self.max_batch:
+                self._emit(room, self._buffers.pop(room))
+
+    def _flush_later(self, room):
+        self.socketio.sleep(self.max_latency)
+        self.flush(room)
+
+    def flush(self, room):
+        """Send whatever is buffered for a room"""
+
+        with self._lock:
+            batch = self._buffers.pop(room, None)
+            if batch:
+                self._emit(room, batch)
+
+    def _emit(self, room, batch):
+        self.batches += 1
+        self.socketio.emit(self.event, self.pack(batch) if self.pack else batch, to=room)
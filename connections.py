@@ -0,0 +1,49 @@
+import threading
+
+
+class Connection:
+    """State of one Socket.IO connection: who is connected and which channels it follows.
+
+    Channels are added only after membership was verified, so socket events
+    can trust `channels` without touching the session or the database.
+    """
+
+    def __init__(self, sid, user_id):
+        self.sid = sid
+        self.user_id = user_id
+        self.channels = set()
+        self.active_channel = None
+
+    def follows(self, channel_id):
+        return channel_id in self.channels
+
+
+class Connections:
+    """Registry of the connections handled by this worker, keyed by Socket.IO sid"""
+
+    def __init__(self):
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def open(self, sid, user_id):
+        connection = Connection(sid, user_id)
+        with self._lock:
+            self._connections[sid] = connection
+        return connection
+
+    def get(self, sid):
+        return self._connections.get(sid)
+
+    def close(self, sid):
+        with self._lock:
+            return self._connections.pop(sid, None)
+
+    def stats(self):
+        """Return the number of open connections and channel subscriptions"""
+
+        with self._lock:
+            connections = list(self._connections.values())
+        return {
+            "connections": len(connections),
+            "subscriptions": sum(len(connection.channels) for connection in connections),
+        }
@@ -0,0 +1,130 @@
+import queue
+import sqlite3
+import threading
+import time
+
+# Applied to every new connection, WAL lets readers keep going while a writer commits
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,
+    "busy_timeout": 5000,
+    "temp_store": "MEMORY",
+}
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection became available in time"""
+
+
+class ConnectionPool:
+    """Pool of pre-configured SQLite connections shared by requests and socket events.
+
+    Connections are opened lazily up to `size` and handed out to one green thread
+    at a time. With eventlet monkey patching the queue and lock below are green,
+    so waiting for a connection yields to other greenlets instead of blocking.
+    """
+
+    def __init__(self, database, size=10, timeout=30, pragmas=PRAGMAS, factory=sqlite3.Connection):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = pragmas
+        self.factory = factory
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._acquired = 0
+        self._timeouts = 0
+        self._wait_seconds = 0.0
+
+    def connect(self):
+        """Open a new connection with the pool pragmas applied"""
+
+        db = sqlite3.connect(self.database, timeout=self.timeout, check_same_thread=False, factory=self.factory)
+        for name, value in self.pragmas.items():
+            db.execute("PRAGMA %s = %s" % (name, value))
+        return db
+
+    def acquire(self):
+        """Take a connection from the pool, opening one if the pool isn't full"""
+
+        with self._lock:
+            create = self._idle.empty() and self._created < self.size
+            if create:
+                self._created += 1
+
+        if create:
+            try:
+                db = self.connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        else:
+            start = time.monotonic()
+            with self._lock:
+                self._waiting += 1
+            try:
+                db = self._idle.get(timeout=self.timeout)
+            except queue.Empty:
+                with self._lock:
+                    self._timeouts += 1
+                raise PoolTimeout("no database connection available after %ss" % self.timeout)
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+                    self._wait_seconds += time.monotonic() - start
+
+        with self._lock:
+            self._in_use += 1
+            self._acquired += 1
+        return db
+
+    def release(self, db):
+        """Return a connection to the pool, discarding any unfinished transaction"""
+
+        try:
+            if db.in_transaction:
+                db.rollback()
+        except sqlite3.Error:
+            # Broken connection, make room for a fresh one
+            db.close()
+            with self._lock:
+                self._in_use -= 1
+                self._created -= 1
+            return
+
+        with self._lock:
+            self._in_use -= 1
+        self._idle.put(db)
+
+    def close(self):
+        """Close every idle connection"""
+
+        while True:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            db.close()
+            with self._lock:
+                self._created -= 1
+
+    def stats(self):
+        """Return pool usage counters"""
+
+        with self._lock:
+            return {
+                "size": self.size,
+                "connections": self._created,
+                "in_use": self._in_use,
+                "idle": self._idle.qsize(),
+                "waiting": self._waiting,
+                "acquired_total": self._acquired,
+                "timeouts_total": self._timeouts,
+                "wait_seconds_total": round(self._wait_seconds, 6),
+            }
@@ -7,8 +7,11 @@ set -e
 echo "Installing dependencies..."
 pip install -r requirements.txt
 
-# Create the database
-echo "Creating the database..."
-sqlite3 chat_group.db < init.sql
+# Create or migrate the database
+echo "Migrating the database..."
+python migrate.py chat_group.db
+
+# Ensure every query is served by an index
+python migrate.py --check
 
 echo "Deployment complete!"
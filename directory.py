@@ -0,0 +1,61 @@
+import threading
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class ChannelDirectory:
+    """In-memory list of every channel, newest first, with a trigram index for name search.
+
+    The directory is tagged with a version (the highest channel id, channels are
+    never edited or deleted) and reloaded by the caller whenever the version in
+    the database moves on.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.channels = []
+        self._names = []
+        self._index = {}
+        self._lock = threading.Lock()
+
+    def load(self, channels, version):
+        """Replace the directory with `channels`, given newest first"""
+
+        names = [channel["name"].lower() for channel in channels]
+
+        index = {}
+        for position, name in enumerate(names):
+            for trigram in trigrams(name):
+                index.setdefault(trigram, []).append(position)
+
+        with self._lock:
+            self.channels = channels
+            self._names = names
+            self._index = index
+            self.version = version
+
+    def search(self, text, offset=0, limit=50):
+        """Return a page of channels whose name contains `text`, and the total number of matches"""
+
+        with self._lock:
+            channels, names, index = self.channels, self._names, self._index
+
+        text = text.lower().strip()
+        if not text:
+            return channels[offset:offset + limit], len(channels)
+
+        if len(text) < 3:
+            positions = [position for position, name in enumerate(names) if text in name]
+        else:
+            # Intersect the posting lists, smallest first, then confirm the substring
+            postings = sorted((index.get(trigram, []) for trigram in trigrams(text)), key=len)
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+                candidates.intersection_update(posting)
+                if not candidates:
+                    break
+            positions = sorted(position for position in candidates if text in names[position])
+
+        return [channels[position] for position in positions[offset:offset + limit]], len(positions)
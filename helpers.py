@@ -1,11 +1,16 @@
 import os
 import pytz
+import hashlib
+import hmac
+from bisect import bisect_right
 from datetime import datetime, timedelta
-from flask import redirect, render_template, session
-from functools import wraps
+from flask import current_app, redirect, render_template, session, request, jsonify
+from functools import lru_cache, wraps
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
+MONTHS = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October", "November", "December"]
+
 def apology(message, code=400):
     """Render message as an apology to user."""
 
@@ -47,6 +52,24 @@ def login_required(f):
     return decorated_function
 
 
+def metrics_access_required(f):
+    """
+    Decorate metrics routes to answer only scrapers on this host, or ones
+    sending the METRICS_TOKEN as a bearer token.
+    """
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if request.remote_addr not in ("127.0.0.1", "::1"):
+            token = current_app.config.get("METRICS_TOKEN")
+            authorization = request.headers.get("Authorization", "").encode()
+            if not token or not hmac.compare_digest(authorization, ("Bearer " + token).encode()):
+                return jsonify({"error": "forbidden"}), 403
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
 def validate_password(password):
     # Check if password meets minimum length requirement
     if len(password) < 8:
@@ -78,18 +101,82 @@ def make_initial(name):
         return words[0][0].upper() + words[0][1].upper()
 
 
-def format_message_date(iso_date):
+@lru_cache(maxsize=None)
+def get_timezone(name):
+    """Resolve a timezone once per process"""
+    return pytz.timezone(name)
+
+
+def local_now():
+    """Return the current time in the configured timezone"""
+    return datetime.now(get_timezone(os.getenv("TIMEZONE")))
+
+
+def local_date(iso_date):
+    """Return the date of a UTC database timestamp in the configured timezone"""
+    return message_date_parts(iso_date, os.getenv("TIMEZONE"))[0]
+
+
+def utc_offset(dt, timezone):
+    """Return the offset of a timezone at a naive UTC time, found in pytz's list of transitions like its fromutc does"""
+    timezone = get_timezone(timezone)
+    transitions = getattr(timezone, "_utc_transition_times", None)
+    if not transitions:
+        return timezone.utcoffset(None) or timedelta(0)
+    return timezone._transition_info[max(bisect_right(transitions, dt) - 1, 0)][0]
+
+
+@lru_cache(maxsize=16384)
+def message_date_parts(iso_date, timezone):
+    """Pre-format a UTC database timestamp, message rows never change so the parts are memoized"""
     dt_object = datetime.fromisoformat(iso_date)
-    dt_object = dt_object.replace(tzinfo=pytz.utc).astimezone(pytz.timezone(os.getenv("TIMEZONE")))
-    
-    # Check if the date is today
-    if dt_object.date() == datetime.now().date():
-        return "today at " + dt_object.strftime("%I:%M %p")
-    
-    # Check if the date is yesterday
-    elif dt_object.date() == datetime.now().date() - timedelta(days=1):
-        return "yesterday at " + dt_object.strftime("%I:%M %p")
-    
-    # Return the date in the format /month/day/year time
-    else:
-        return dt_object.strftime("%m/%d/%Y %I:%M %p")
+    dt_object = dt_object + utc_offset(dt_object, timezone)
+
+    # Same output as strftime("%I:%M %p"), "%m/%d/%Y %I:%M %p" and "%B %d, %Y" without the strftime cost
+    time = "%02d:%02d %s" % ((dt_object.hour - 1) % 12 + 1, dt_object.minute, "AM" if dt_object.hour < 12 else "PM")
+    return (
+        dt_object.date(),
+        time,
+        "%02d/%02d/%04d %s" % (dt_object.month, dt_object.day, dt_object.year, time),
+        "%s %02d, %04d" % (MONTHS[dt_object.month - 1], dt_object.day, dt_object.year),
+    )
+
+
+def format_messages(messages):
+    """Convert the dates of a page of message rows to human readable dates, in place"""
+    timezone = os.getenv("TIMEZONE")
+    today = local_now().date()
+    yesterday = today - timedelta(days=1)
+
+    for message in messages:
+        date, time, full, day = message_date_parts(message["created_at"], timezone)
+
+        if message["is_start_date"]:
+            message["start_date_at"] = day
+
+        if date == today:
+            message["created_at"] = "today at " + time
+        elif date == yesterday:
+            message["created_at"] = "yesterday at " + time
+        else:
+            message["created_at"] = full
+
+    return messages
+
+
+def messages_modified_at(iso_date):
+    """Return when a page of messages last changed, relative dates roll over at local midnight"""
+    midnight = local_now().replace(hour=0, minute=0, second=0, microsecond=0)
+    if iso_date is None:
+        return midnight
+    return max(datetime.fromisoformat(iso_date).replace(tzinfo=pytz.utc), midnight)
+
+
+def conditional_json(payload, last_modified=None):
+    """Return a JSON response validated by a content ETag, answering 304 when the client has it"""
+    response = jsonify(payload)
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response.make_conditional(request)
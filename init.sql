@@ -41,6 +41,9 @@ CREATE TABLE messages (
     FOREIGN KEY (channel_id) REFERENCES channels(id)
 );
 
+-- Index messages by channel for cursor pagination
+CREATE INDEX messages_channel_id_id ON messages (channel_id, id);
+
 -- Insert the default user
 INSERT INTO users (username, email, name, hash) VALUES ('admin', 'admin@localhost', 'Admin', '$2b$10$1J');
 
@@ -0,0 +1,192 @@
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from a cached lookup to a stalled request
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, escape(value)) for name, value in zip(names, values))
+
+
+class Counter:
+    """Monotonic count per label set"""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield self.name, format_labels(self.labels, labels), value
+
+
+class Histogram:
+    """Distribution of observed durations per label set, with Prometheus cumulative buckets"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # One slot per bucket, then the sum and the total count
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            values = {labels: list(counts) for labels, counts in self._values.items()}
+
+        names = self.labels + ("le",)
+        for labels, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield self.name + "_bucket", format_labels(names, labels + ("%g" % bound,)), cumulative
+            yield self.name + "_bucket", format_labels(names, labels + ("+Inf",)), counts[-1]
+            yield self.name + "_sum", format_labels(self.labels, labels), round(counts[-2], 6)
+            yield self.name + "_count", format_labels(self.labels, labels), counts[-1]
+
+
+class Gauge:
+    """Current values read from a callback when the metrics are scraped.
+
+    The callback returns a number, or a dict of label value to number for a
+    single label.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, callback, labels=()):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.labels = tuple(labels)
+
+    def samples(self):
+        value = self.callback()
+        if isinstance(value, dict):
+            for label, number in sorted(value.items()):
+                yield self.name, format_labels(self.labels, (label,)), number
+        else:
+            yield self.name, "", value
+
+
+class Registry:
+    """Set of metrics rendered together in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, callback, labels=()):
+        return self.add(Gauge(name, help, callback, labels))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            try:
+                for name, labels, value in metric.samples():
+                    lines.append("%s%s %s" % (name, labels, value))
+            except Exception:
+                logger.exception("Collecting %s failed", metric.name)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+query_seconds = registry.histogram("chat_db_query_seconds", "Time to execute SQL statements, by statement", ("statement",))
+slow_query_seconds = None
+
+
+def normalize_statement(sql):
+    """Collapse whitespace so each statement in the code maps to one label"""
+
+    return re.sub(r"\s+", " ", sql).strip()[:200]
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that records how long each statement takes to execute"""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose cursors, including the ones behind Connection.execute, are timed"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+
+def record_query(sql, seconds):
+    statement = normalize_statement(sql)
+    query_seconds.observe(seconds, statement)
+
+    if slow_query_seconds is not None and seconds >= slow_query_seconds:
+        logger.warning("Slow query took %.1f ms: %s", seconds * 1000, statement)
+
+
+def log_slow_queries(milliseconds):
+    """Log statements slower than `milliseconds`, None turns logging off"""
+
+    global slow_query_seconds
+    slow_query_seconds = milliseconds / 1000 if milliseconds is not None else None
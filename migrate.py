@@ -0,0 +1,213 @@
+"""Apply versioned schema migrations to the SQLite database.
+
+Usage:
+    python migrate.py [database]     Migrate the database (defaults to $DATABASE)
+    python migrate.py --check        Fail if any query does a full table scan
+"""
+
+import ast
+import glob
+import os
+import re
+import sqlite3
+import sys
+import time
+
+from dotenv import load_dotenv
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+MIGRATIONS_DIR = os.path.join(ROOT, "migrations")
+
+# init.sql is the baseline schema, every file in migrations/ builds on top of it
+BASELINE_VERSION = 1
+
+# Query plan detail of a full table scan, with the table name
+FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)$")
+
+# Rows indexed per transaction when a migration backfills a full-text index, and the pause
+# between transactions that lets the app's writes through
+BACKFILL_BATCH_SIZE = 5000
+BACKFILL_PAUSE = 0.05
+
+
+def list_migrations():
+    """Return (version, path) of every migration file, in order"""
+
+    migrations = []
+    for path in glob.glob(os.path.join(MIGRATIONS_DIR, "*.sql")):
+        match = re.match(r"(\d+)_", os.path.basename(path))
+        if match:
+            migrations.append((int(match.group(1)), path))
+    return sorted(migrations)
+
+
+def apply_script(db, sql, version=None):
+    """Run a script and bump the schema version, if given, in a single transaction"""
+
+    if version is not None:
+        sql += "\nPRAGMA user_version = %d;" % version
+
+    try:
+        db.executescript("BEGIN IMMEDIATE;\n" + sql + "\nCOMMIT;")
+    except sqlite3.Error:
+        if db.in_transaction:
+            db.rollback()
+        raise
+
+
+def backfill_index(db, fts, table, columns):
+    """Index the existing rows of `table` into its external content `fts` table.
+
+    Rows are copied in id ranges, each in its own short transaction, so the
+    app only waits for one batch at a time instead of the whole table. Rows
+    already in the index, added by the triggers or by an interrupted run,
+    are skipped.
+    """
+
+    first_id, last_id = db.execute("SELECT MIN(id), MAX(id) FROM %s" % table).fetchone()
+    if first_id is None:
+        return
+
+    columns = ", ".join(columns)
+    sql = """
+        INSERT INTO {fts} (rowid, {columns})
+        SELECT id, {columns} FROM {table}
+        WHERE id BETWEEN ? AND ? AND id NOT IN (SELECT id FROM {fts}_docsize WHERE id BETWEEN ? AND ?)
+    """.format(fts=fts, table=table, columns=columns)
+
+    for low in range(first_id, last_id + 1, BACKFILL_BATCH_SIZE):
+        high = low + BACKFILL_BATCH_SIZE - 1
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute(sql, (low, high, low, high))
+            db.commit()
+        except sqlite3.Error:
+            if db.in_transaction:
+                db.rollback()
+            raise
+        time.sleep(BACKFILL_PAUSE)
+
+
+def backfill_search(db):
+    backfill_index(db, "messages_fts", "messages", ["message", "channel_id"])
+    backfill_index(db, "channels_fts", "channels", ["name", "description"])
+
+
+# Data to fill in after a migration's schema is created, the version is bumped once it's done
+BACKFILLS = {
+    3: backfill_search,
+}
+
+
+def migrate(database):
+    """Bring the database up to the latest schema version"""
+
+    db = sqlite3.connect(database, timeout=30)
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+
+    if version == 0:
+        tables = db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'users'").fetchall()
+
+        # Databases created from init.sql before migrations existed are already at the baseline
+        if len(tables) > 0:
+            db.execute("PRAGMA user_version = %d" % BASELINE_VERSION)
+        else:
+            with open(os.path.join(ROOT, "init.sql")) as f:
+                apply_script(db, f.read(), BASELINE_VERSION)
+            print("Applied init.sql")
+        version = BASELINE_VERSION
+
+    for number, path in list_migrations():
+        if number <= version:
+            continue
+
+        with open(path) as f:
+            sql = f.read()
+
+        backfill = BACKFILLS.get(number)
+        if backfill:
+            apply_script(db, sql)
+            backfill(db)
+            apply_script(db, "", number)
+        else:
+            apply_script(db, sql, number)
+        version = number
+        print("Applied " + os.path.basename(path))
+
+    db.close()
+    return version
+
+
+def find_queries(path):
+    """Return (line, sql) of every literal query passed to execute() in a module"""
+
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+
+    queries = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call) or not isinstance(node.func, ast.Attribute):
+            continue
+        if node.func.attr not in ("execute", "executemany") or not node.args:
+            continue
+
+        arg = node.args[0]
+        if isinstance(arg, ast.Constant) and isinstance(arg.value, str):
+            sql = arg.value.strip()
+            if re.match(r"(SELECT|INSERT|UPDATE|DELETE|WITH)\b", sql, re.IGNORECASE):
+                queries.append((node.lineno, sql))
+    return queries
+
+
+def full_scans(plan):
+    """Return the details of the query plan rows that walk every row of a table"""
+
+    # A bare "SCAN <table>" ("SCAN TABLE <table>" before SQLite 3.36) is a full scan;
+    # index, virtual table, constant and schema scans are fine
+    scans = []
+    for row in plan:
+        match = FULL_SCAN.match(row[3])
+        if match and match.group(1) != "sqlite_master":
+            scans.append(row[3])
+    return scans
+
+
+def check_query_plans(paths):
+    """Print every query that scans a whole table, return the number found"""
+
+    db = sqlite3.connect(":memory:")
+    with open(os.path.join(ROOT, "init.sql")) as f:
+        db.executescript(f.read())
+    for _, path in list_migrations():
+        with open(path) as f:
+            db.executescript(f.read())
+    db.commit()
+
+    failures = 0
+    for path in paths:
+        for line, sql in find_queries(path):
+            params = [None] * sql.count("?")
+            plan = db.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+
+            for detail in full_scans(plan):
+                failures += 1
+                print("%s:%d: %s" % (os.path.relpath(path, ROOT), line, detail))
+
+    db.close()
+    return failures
+
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--check":
+        paths = sys.argv[2:] or sorted(path for path in glob.glob(os.path.join(ROOT, "*.py")) if path != os.path.abspath(__file__))
+        failures = check_query_plans(paths)
+        if failures:
+            sys.exit("%d full table scan(s) found" % failures)
+        print("No full table scans found")
+    else:
+        database = sys.argv[1] if len(sys.argv) > 1 else os.getenv("DATABASE")
+        if not database:
+            sys.exit("usage: python migrate.py [database]")
+        print("Database is at version %d" % migrate(database))
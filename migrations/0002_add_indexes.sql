@@ -0,0 +1,17 @@
+-- Index messages by channel for cursor pagination (databases created before it was in init.sql)
+CREATE INDEX IF NOT EXISTS messages_channel_id_id ON messages (channel_id, id);
+
+-- Cover the latest message date lookup of a channel
+CREATE INDEX IF NOT EXISTS messages_channel_id_created_at ON messages (channel_id, created_at);
+
+-- Remove duplicated memberships before enforcing uniqueness
+DELETE FROM members WHERE id NOT IN (SELECT MIN(id) FROM members GROUP BY channel_id, user_id);
+
+-- Allow a user to join a channel only once
+CREATE UNIQUE INDEX IF NOT EXISTS members_channel_id_user_id ON members (channel_id, user_id);
+
+-- Cover the member list of a channel, newest first
+CREATE INDEX IF NOT EXISTS members_channel_id_created_at ON members (channel_id, created_at, user_id);
+
+-- Sort the channel list by creation date
+CREATE INDEX IF NOT EXISTS channels_created_at ON channels (created_at);
@@ -0,0 +1,35 @@
+-- Full-text index over messages, channel_id is indexed as a token to filter by channel inside the index
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(message, channel_id, content='messages', content_rowid='id');
+
+-- Full-text index over channels
+CREATE VIRTUAL TABLE IF NOT EXISTS channels_fts USING fts5(name, description, content='channels', content_rowid='id');
+
+-- Keep the indexes in sync with their tables
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, message, channel_id) VALUES (new.id, new.message, new.channel_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, message, channel_id) VALUES ('delete', old.id, old.message, old.channel_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message, channel_id ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, message, channel_id) VALUES ('delete', old.id, old.message, old.channel_id);
+    INSERT INTO messages_fts (rowid, message, channel_id) VALUES (new.id, new.message, new.channel_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS channels_fts_insert AFTER INSERT ON channels BEGIN
+    INSERT INTO channels_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS channels_fts_delete AFTER DELETE ON channels BEGIN
+    INSERT INTO channels_fts (channels_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS channels_fts_update AFTER UPDATE OF name, description ON channels BEGIN
+    INSERT INTO channels_fts (channels_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+    INSERT INTO channels_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+END;
+
+-- Existing rows are indexed afterwards by migrate.py in short batches, IF NOT EXISTS lets
+-- an interrupted migration run again
@@ -0,0 +1,17 @@
+-- Count members per channel instead of materializing the member list
+ALTER TABLE channels ADD COLUMN member_count INTEGER NOT NULL DEFAULT 0;
+
+UPDATE channels SET member_count = (SELECT COUNT(*) FROM members WHERE members.channel_id = channels.id);
+
+-- Keep the counter in sync, ignored duplicate joins don't fire the trigger
+CREATE TRIGGER members_count_insert AFTER INSERT ON members BEGIN
+    UPDATE channels SET member_count = member_count + 1 WHERE id = new.channel_id;
+END;
+
+CREATE TRIGGER members_count_delete AFTER DELETE ON members BEGIN
+    UPDATE channels SET member_count = member_count - 1 WHERE id = old.channel_id;
+END;
+
+-- Page through the members of a channel, newest first
+CREATE INDEX IF NOT EXISTS members_channel_id_id ON members (channel_id, id);
+DROP INDEX IF EXISTS members_channel_id_created_at;
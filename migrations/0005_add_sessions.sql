@@ -0,0 +1,9 @@
+-- Server-side sessions shared by every worker
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    expires_at INTEGER NOT NULL
+) WITHOUT ROWID;
+
+-- Find expired sessions for the background cleanup
+CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at);
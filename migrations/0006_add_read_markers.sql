@@ -0,0 +1,27 @@
+-- Count messages per channel, unread counts are this minus what each member has read
+ALTER TABLE channels ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE channels ADD COLUMN last_message_id INTEGER NOT NULL DEFAULT 0;
+
+UPDATE channels SET
+    message_count = (SELECT COUNT(*) FROM messages WHERE messages.channel_id = channels.id),
+    last_message_id = (SELECT COALESCE(MAX(id), 0) FROM messages WHERE messages.channel_id = channels.id);
+
+CREATE TRIGGER messages_count_insert AFTER INSERT ON messages BEGIN
+    UPDATE channels SET message_count = message_count + 1, last_message_id = MAX(last_message_id, new.id) WHERE id = new.channel_id;
+END;
+
+CREATE TRIGGER messages_count_delete AFTER DELETE ON messages BEGIN
+    UPDATE channels SET message_count = message_count - 1 WHERE id = old.channel_id;
+END;
+
+-- Read marker of each member: the last message read and how many messages that covers
+ALTER TABLE members ADD COLUMN last_read_id INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE members ADD COLUMN read_count INTEGER NOT NULL DEFAULT 0;
+
+-- Existing members start with everything read
+UPDATE members SET
+    last_read_id = (SELECT last_message_id FROM channels WHERE channels.id = members.channel_id),
+    read_count = (SELECT message_count FROM channels WHERE channels.id = members.channel_id);
+
+-- Cover the channels and read counts of a user
+CREATE INDEX IF NOT EXISTS members_user_id_channel_id ON members (user_id, channel_id, read_count);
@@ -0,0 +1,206 @@
+import atexit
+import glob
+import logging
+import os
+import pickle
+import socket
+import stat
+import threading
+from collections import defaultdict
+
+import msgspec
+import socketio
+
+logger = logging.getLogger(__name__)
+
+# Largest pub/sub message accepted by the Unix socket backend
+MAX_DATAGRAM = 256 * 1024
+
+# Seconds to wait for a worker whose receive queue is full
+SEND_TIMEOUT = 5
+
+# Per-user directory for the Unix socket backend when the url names none
+DEFAULT_SOCKET_DIR = os.path.join(os.getenv("XDG_RUNTIME_DIR") or os.path.expanduser("~/.cache"), "chat-group-mq")
+
+
+def private_directory(path):
+    """Create a directory only this user can use, refusing one that anybody else could.
+
+    Whoever can write to the socket directory can send datagrams to every
+    worker, so it must be a real directory (not a symlink) owned by this user
+    with mode 0700.
+    """
+
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or stat.S_IMODE(info.st_mode) != 0o700:
+        raise RuntimeError("%s must be a directory owned by uid %d with mode 0700" % (path, os.getuid()))
+    return path
+
+
+class Bus:
+    """Publish application events (cache invalidations, state updates) to every worker.
+
+    Handlers run in the publishing process immediately and in the other worker
+    processes when the Socket.IO message queue delivers the event. Without a
+    message queue only local handlers run.
+    """
+
+    def __init__(self):
+        self.manager = None
+        self._handlers = defaultdict(list)
+
+    def subscribe(self, topic, handler=None):
+        """Register a handler for a topic, usable as a decorator"""
+
+        def decorator(f):
+            self._handlers[topic].append(f)
+            return f
+
+        return decorator(handler) if handler else decorator
+
+    def publish(self, topic, payload):
+        """Run the handlers of a topic here and in every other worker"""
+
+        self.dispatch(topic, payload)
+
+        if self.manager is not None:
+            self.manager._publish({"method": "bus", "topic": topic, "payload": payload, "host_id": self.manager.host_id})
+
+    def dispatch(self, topic, payload):
+        """Run the local handlers of a topic"""
+
+        for handler in self._handlers[topic]:
+            try:
+                handler(payload)
+            except Exception:
+                logger.exception("Bus handler failed for %s", topic)
+
+
+class BusMixin:
+    """Deliver bus events carried by a pub/sub client manager"""
+
+    bus = None
+
+    def _listen(self):
+        for message in super()._listen():
+            data = message
+            if isinstance(message, bytes):
+                try:
+                    data = pickle.loads(message)
+                except Exception:
+                    pass
+
+            if isinstance(data, dict) and data.get("method") == "bus":
+                if data.get("host_id") != self.host_id and self.bus is not None:
+                    self.bus.dispatch(data["topic"], data["payload"])
+                continue
+
+            yield message
+
+
+class UnixSocketManager(socketio.PubSubManager):
+    """Share Socket.IO rooms between worker processes on one host, no broker needed.
+
+    Every worker binds a Unix datagram socket inside the directory given by the
+    url (unix:///path/to/dir, or unix:// for a directory in $XDG_RUNTIME_DIR or
+    ~/.cache) and publishes by sending to all the sockets found there. Sockets
+    left behind by dead workers are removed on the first failed send. Messages
+    are MessagePack, never pickles, so a datagram can't run code in a worker.
+    """
+
+    name = "unix"
+
+    def __init__(self, url="unix://", channel="flask-socketio", write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        base = url[len("unix://"):] or DEFAULT_SOCKET_DIR
+        os.makedirs(os.path.dirname(os.path.abspath(base)), exist_ok=True)
+        self.directory = private_directory(os.path.join(private_directory(base), channel))
+
+        self.path = os.path.join(self.directory, self.host_id + ".sock")
+
+        # Only one green thread may write a socket at a time, and a stuck peer
+        # must not stall the publisher for longer than the send timeout
+        self._send_lock = threading.Lock()
+        self._send_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._send_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, MAX_DATAGRAM)
+        self._send_sock.settimeout(SEND_TIMEOUT)
+        self._recv_sock = None
+        self._encoder = msgspec.msgpack.Encoder()
+        self._decoder = msgspec.msgpack.Decoder(dict)
+
+    def initialize(self):
+        # Bind only once the listener starts, peers never send to a worker that isn't reading
+        if not self.write_only:
+            self._recv_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._recv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+            self._recv_sock.bind(self.path)
+            atexit.register(self.close)
+        super().initialize()
+
+    def close(self):
+        self._send_sock.close()
+        if self._recv_sock is not None:
+            self._recv_sock.close()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+    def _publish(self, data):
+        # Several emit arguments travel as a tuple, which MessagePack turns into a list
+        if isinstance(data.get("data"), tuple):
+            data = dict(data, data=list(data["data"]), tuple_data=True)
+
+        message = self._encoder.encode(data)
+        if len(message) > MAX_DATAGRAM:
+            raise ValueError("pub/sub message of %d bytes exceeds %d" % (len(message), MAX_DATAGRAM))
+
+        with self._send_lock:
+            for path in glob.glob(os.path.join(self.directory, "*.sock")):
+                if path == self.path:
+                    continue
+                try:
+                    self._send_sock.sendto(message, path)
+                except socket.timeout:
+                    logger.warning("Dropped pub/sub message to unresponsive worker %s", path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # The worker owning this socket is gone
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+
+    def _listen(self):
+        while True:
+            message = self._recv_sock.recv(MAX_DATAGRAM)
+            try:
+                data = self._decoder.decode(message)
+            except msgspec.DecodeError:
+                logger.warning("Dropped malformed pub/sub message of %d bytes", len(message))
+                continue
+
+            if data.pop("tuple_data", False):
+                data["data"] = tuple(data["data"])
+            yield data
+
+
+def create_client_manager(url, bus, channel="flask-socketio"):
+    """Build the Socket.IO client manager for a message queue url"""
+
+    if url.startswith("unix://"):
+        base = UnixSocketManager
+    elif url.startswith(("redis://", "rediss://")):
+        base = socketio.RedisManager
+    else:
+        base = socketio.KombuManager
+
+    manager = type(base.__name__, (BusMixin, base), {})(url, channel=channel)
+
+    manager.bus = bus
+    bus.manager = manager
+    return manager
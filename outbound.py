@@ -0,0 +1,137 @@
+import logging
+import threading
+
+from engineio import packet as eio_packet
+from eventlet import queue
+from socketio import packet as sio_packet
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("resync", "disconnect")
+
+
+class SendQueue(queue.Queue):
+    """Outbound packet queue of one Engine.IO socket that holds at most `limit` packets.
+
+    Engine.IO queues every packet for a socket until its transport writes it,
+    without a bound, so a client that stops reading grows this queue for as
+    long as its room keeps talking. Past `limit` the queued Socket.IO events
+    are dropped and the owner decides what the client gets instead. Acks and
+    transport packets such as pings are never dropped.
+    """
+
+    def __init__(self, owner, limit):
+        super().__init__()
+        self.owner = owner
+        self.limit = limit
+
+    def _put(self, item):
+        super()._put(item)
+        if len(self.queue) > self.limit:
+            self.owner.overflow(self)
+
+    def drop_events(self):
+        """Remove every queued event packet, returning how many were dropped"""
+
+        kept = [item for item in self.queue if not is_event(item)]
+        dropped = len(self.queue) - len(kept)
+        self.queue.clear()
+        self.queue.extend(kept)
+
+        # Dropped packets will never be taken, Socket.close(wait=True) joins the queue
+        for _ in range(dropped):
+            self.task_done()
+        return dropped
+
+
+def is_event(item):
+    """Tell Socket.IO EVENT packets, the only ones safe to drop, from everything else"""
+
+    return (
+        item is not None
+        and item.packet_type == eio_packet.MESSAGE
+        and isinstance(item.data, str)
+        and item.data.startswith(str(sio_packet.EVENT))
+    )
+
+
+class OutboundQueues:
+    """Bound the packets buffered for each Socket.IO connection.
+
+    `install` makes the Engine.IO server create a `SendQueue` for each new
+    socket. When one overflows, its queued events are dropped, then with the
+    "resync" policy a single `resync` event is queued so the client fetches
+    what it missed. With the "disconnect" policy the socket is closed.
+    `on_overflow(dropped, policy)` is called on every overflow, for metrics.
+    """
+
+    def __init__(self, limit=1000, policy="resync", on_overflow=None):
+        if policy not in POLICIES:
+            raise ValueError("unknown slow consumer policy %r, expected one of %s" % (policy, ", ".join(POLICIES)))
+
+        self.limit = limit
+        self.policy = policy
+        self.on_overflow = on_overflow
+        self.server = None
+        self.dropped = 0
+        self.overflows = 0
+        self._lock = threading.Lock()
+
+    def install(self, server):
+        """Use bounded queues for the sockets of a python-socketio server opened from now on"""
+
+        self.server = server
+        server.eio.create_queue = self.create_queue
+
+    def create_queue(self, *args, **kwargs):
+        return SendQueue(self, self.limit)
+
+    def overflow(self, send_queue):
+        dropped = send_queue.drop_events()
+        with self._lock:
+            self.dropped += dropped
+            self.overflows += 1
+
+        if self.policy == "resync":
+            # Engine.IO packets carry encoded Socket.IO packets
+            event = self.server.packet_class(sio_packet.EVENT, data=["resync"], namespace="/")
+            send_queue.queue.append(eio_packet.Packet(eio_packet.MESSAGE, data=event.encode()))
+            send_queue._put_bookkeeping()
+        else:
+            # Not while the broadcast that overflowed is still walking the room
+            sid = self.find_sid(send_queue)
+            if sid is not None:
+                logger.info("Disconnecting slow client %s after dropping %d events", sid, dropped)
+                self.server.eio.start_background_task(self.close, sid)
+
+        if self.on_overflow:
+            self.on_overflow(dropped, self.policy)
+
+    def close(self, sid):
+        socket = self.server.eio.sockets.get(sid)
+        if socket is not None:
+            # Waiting for the queue to drain would wait for the slow client
+            socket.close(wait=False)
+
+    def find_sid(self, send_queue):
+        """Return the Engine.IO sid owning a queue, only needed on the rare disconnect"""
+
+        for sid, socket in list(self.server.eio.sockets.items()):
+            if socket.queue is send_queue:
+                return sid
+        return None
+
+    def depths(self):
+        """Return the number of packets queued for each open socket"""
+
+        return [socket.queue.qsize() for socket in list(self.server.eio.sockets.values())]
+
+    def stats(self):
+        depths = self.depths()
+        return {
+            "sockets": len(depths),
+            "queued": sum(depths),
+            "deepest": max(depths, default=0),
+            "dropped": self.dropped,
+            "overflows": self.overflows,
+        }
@@ -0,0 +1,84 @@
+import threading
+import time
+
+from eventlet import tpool
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from cache import TTLCache
+
+
+class HasherBusy(Exception):
+    """Raised when no hashing slot became available in time"""
+
+
+class PasswordHasher:
+    """Hash and check passwords in eventlet's OS thread pool.
+
+    Password hashing is deliberately slow and CPU-bound. Run inline it would
+    block the event loop, and with it every chat broadcast, for its whole
+    duration. At most `concurrency` hashes run at once. Callers wait up to
+    `timeout` seconds for a slot and then get `HasherBusy`.
+    """
+
+    def __init__(self, method="scrypt", concurrency=4, timeout=10):
+        self.method = method
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self.active = 0
+        self.rejected = 0
+
+        # Hashes made with other parameters are upgraded on the next login
+        self.prefix = generate_password_hash("", method).split("$", 1)[0]
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(timeout=self.timeout):
+            self.rejected += 1
+            raise HasherBusy("no password hashing slot available after %ss" % self.timeout)
+        self.active += 1
+        try:
+            return tpool.execute(function, *args)
+        finally:
+            self.active -= 1
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def check(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        return pwhash.split("$", 1)[0] != self.prefix
+
+
+class RateLimiter:
+    """Allow at most `limit` hits per key in each `window` seconds.
+
+    Counts live in a bounded cache, so each worker limits on its own and a
+    flood of distinct keys can't exhaust memory.
+    """
+
+    def __init__(self, limit=10, window=60, maxsize=100000):
+        self.limit = limit
+        self.window = window
+        self._windows = TTLCache(maxsize, window)
+        self._lock = threading.Lock()
+
+    def blocked(self, key):
+        """Tell whether `key` is over its limit in the current window, without counting a hit"""
+
+        with self._lock:
+            start, count = self._windows.get(key) or (0, 0)
+        return time.monotonic() - start < self.window and count >= self.limit
+
+    def hit(self, key):
+        """Count a hit for `key`, returning False once the key is over its limit"""
+
+        now = time.monotonic()
+        with self._lock:
+            start, count = self._windows.get(key) or (now, 0)
+            if now - start >= self.window:
+                start, count = now, 0
+            count += 1
+            self._windows.set(key, (start, count))
+        return count <= self.limit
@@ -0,0 +1,104 @@
+import bisect
+import threading
+from collections import OrderedDict
+
+
+class RecentMessages:
+    """Latest message rows of each channel, kept in memory in id order.
+
+    A channel's buffer starts from a database page (`warm`) and then grows
+    with every stored message (`add`), dropping the oldest past `size` rows. Rows
+    added to channels that were never warmed are ignored, so a buffer never has
+    gaps. It can then answer first pages and reconnect deltas that fall inside
+    it. At most `max_channels` buffers are kept, least recently used go first.
+
+    Rows are dicts with the columns of `query_messages`, created_at still in
+    UTC. Callers get copies they are free to format in place.
+    """
+
+    def __init__(self, size=200, max_channels=1024):
+        self.size = size
+        self.max_channels = max_channels
+        self._channels = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def warm(self, channel_id, rows):
+        """Start a channel's buffer from its latest rows, newest first, unless it has one"""
+
+        with self._lock:
+            if channel_id in self._channels:
+                return
+
+            # Fewer rows than asked for means the buffer holds the whole channel
+            complete = len(rows) < self.size
+            self._channels[channel_id] = {"rows": [dict(row) for row in reversed(rows[:self.size])], "complete": complete}
+            while len(self._channels) > self.max_channels:
+                self._channels.popitem(last=False)
+
+    def add(self, channel_id, row):
+        """Add a stored message to a warm buffer, in id order and once"""
+
+        with self._lock:
+            buffer = self._channels.get(channel_id)
+            if buffer is None:
+                return
+
+            rows = buffer["rows"]
+            index = bisect.bisect_left(rows, row["id"], key=lambda message: message["id"])
+
+            # Already loaded from the database or delivered twice
+            if index < len(rows) and rows[index]["id"] == row["id"]:
+                return
+
+            rows.insert(index, dict(row))
+            if len(rows) > self.size:
+                del rows[0]
+                buffer["complete"] = False
+
+    def latest(self, channel_id, limit=20):
+        """Return the latest `limit` rows newest first, None when the buffer can't tell"""
+
+        with self._lock:
+            buffer = self._channels.get(channel_id)
+            if buffer is None or (limit > len(buffer["rows"]) and not buffer["complete"]):
+                self.misses += 1
+                return None
+
+            self._channels.move_to_end(channel_id)
+            self.hits += 1
+            return [dict(row) for row in reversed(buffer["rows"][-limit:])]
+
+    def since(self, channel_id, after):
+        """Return the rows newer than message id `after` oldest first, None when older ones were dropped"""
+
+        with self._lock:
+            buffer = self._channels.get(channel_id)
+            if buffer is None:
+                self.misses += 1
+                return None
+
+            # Ids are shared by every channel, only rows from the oldest buffered one on are known
+            rows = buffer["rows"]
+            if not buffer["complete"] and (not rows or after < rows[0]["id"]):
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return [dict(row) for row in rows if row["id"] > after]
+
+    def clear(self):
+        with self._lock:
+            self._channels.clear()
+
+    def stats(self):
+        """Return buffer usage counters"""
+
+        with self._lock:
+            return {
+                "channels": len(self._channels),
+                "messages": sum(len(buffer["rows"]) for buffer in self._channels.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,89 @@
+import re
+
+# Terms are quoted so user input can never be parsed as FTS5 query syntax
+TERM = re.compile(r"\w+", re.UNICODE)
+
+
+def match_query(text, column, prefix=True):
+    """Build an FTS5 MATCH expression requiring every word of `text` in `column`"""
+
+    terms = ['"%s"' % term for term in TERM.findall(text)]
+    if not terms:
+        return None
+
+    # Match the last word as a prefix so results follow the user while typing
+    if prefix:
+        terms[-1] += "*"
+    return "{%s} : (%s)" % (column, " ".join(terms))
+
+
+def search_messages(cursor, text, channel_id=None, sort="rank", after=None, limit=20):
+    """Search messages, best matches or newest first, resuming after the `after` cursor.
+
+    The cursor is the message id for recent order and "rank:id" for rank order.
+    Return the rows and the cursor of the next page.
+    """
+
+    query = match_query(text, "message")
+    if query is None:
+        return [], None
+    if channel_id:
+        query = '{channel_id} : "%d" AND %s' % (channel_id, query)
+
+    if sort == "recent" and after:
+        rows = cursor.execute("""
+            SELECT messages.id, messages.channel_id, channels.name AS channel_name, users.name, users.profile_url, messages.message, messages.created_at, messages.is_start_date FROM messages_fts
+            JOIN messages ON messages.id = messages_fts.rowid
+            JOIN users ON messages.user_id = users.id
+            JOIN channels ON messages.channel_id = channels.id
+            WHERE messages_fts MATCH ? AND messages_fts.rowid < ?
+            ORDER BY messages_fts.rowid DESC
+            LIMIT ?
+        """, (query, int(after), limit)).fetchall()
+    elif sort == "recent":
+        rows = cursor.execute("""
+            SELECT messages.id, messages.channel_id, channels.name AS channel_name, users.name, users.profile_url, messages.message, messages.created_at, messages.is_start_date FROM messages_fts
+            JOIN messages ON messages.id = messages_fts.rowid
+            JOIN users ON messages.user_id = users.id
+            JOIN channels ON messages.channel_id = channels.id
+            WHERE messages_fts MATCH ?
+            ORDER BY messages_fts.rowid DESC
+            LIMIT ?
+        """, (query, limit)).fetchall()
+
+    if sort == "recent":
+        next_cursor = str(rows[-1]["id"]) if len(rows) == limit else None
+        return rows, next_cursor
+
+    rank, id = float("-inf"), 0
+    if after:
+        rank, id = after.rsplit(":", 1)
+        rank, id = float(rank), int(id)
+
+    rows = cursor.execute("""
+        SELECT messages.id, messages.channel_id, channels.name AS channel_name, users.name, users.profile_url, messages.message, messages.created_at, messages.is_start_date, messages_fts.rank FROM messages_fts
+        JOIN messages ON messages.id = messages_fts.rowid
+        JOIN users ON messages.user_id = users.id
+        JOIN channels ON messages.channel_id = channels.id
+        WHERE messages_fts MATCH ? AND (messages_fts.rank > ? OR (messages_fts.rank = ? AND messages_fts.rowid > ?))
+        ORDER BY messages_fts.rank, messages_fts.rowid
+        LIMIT ?
+    """, (query, rank, rank, id, limit)).fetchall()
+    next_cursor = "%r:%d" % (rows[-1]["rank"], rows[-1]["id"]) if len(rows) == limit else None
+    return rows, next_cursor
+
+
+def search_channels(cursor, text, limit=5):
+    """Search channels by name and description, best matches first"""
+
+    query = match_query(text, "name description")
+    if query is None:
+        return []
+
+    return cursor.execute("""
+        SELECT channels.* FROM channels_fts
+        JOIN channels ON channels.id = channels_fts.rowid
+        WHERE channels_fts MATCH ?
+        ORDER BY channels_fts.rank
+        LIMIT ?
+    """, (query, limit)).fetchall()
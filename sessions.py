@@ -0,0 +1,123 @@
+import logging
+import threading
+import time
+
+from flask_session.base import ServerSideSession, ServerSideSessionInterface
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteSession(ServerSideSession):
+    pass
+
+
+class SQLiteSessionInterface(ServerSideSessionInterface):
+    """Store sessions in the `sessions` table, with an in-memory LRU tier in front.
+
+    Every worker reads and writes the same table, so a session created by one
+    worker is visible to the others. Recently used sessions are served from
+    memory; writes are announced on the bus so other workers drop their copy.
+    A session whose data didn't change is only written back once half of its
+    lifetime has passed. Expired rows are deleted by a background green thread
+    every `cleanup_interval` seconds.
+    """
+
+    session_class = SQLiteSession
+    ttl = True
+
+    def __init__(self, app, pool, bus, cache_size=10000, cache_ttl=300, cleanup_interval=600, **kwargs):
+        self.pool = pool
+        self.bus = bus
+        self.cache = TTLCache(cache_size, cache_ttl)
+        self.cleanup_interval = cleanup_interval
+        self._thread = None
+        self.deleted = 0
+        super().__init__(app, **kwargs)
+
+        bus.subscribe("session_changed", self.cache.delete)
+
+    def start(self):
+        """Start deleting expired sessions in the background"""
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="session-cleanup", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.cleanup_interval)
+            try:
+                self._delete_expired_sessions()
+            except Exception:
+                logger.exception("Session cleanup failed")
+
+    def _retrieve_session_data(self, store_id):
+        item = self.cache.get(store_id)
+        if item is None:
+            db = self.pool.acquire()
+            try:
+                row = db.execute("SELECT data, expires_at FROM sessions WHERE id = ?", (store_id,)).fetchone()
+            finally:
+                self.pool.release(db)
+
+            if row is None:
+                return None
+            item = (bytes(row[0]), row[1])
+            self.cache.set(store_id, item)
+
+        data, expires_at = item
+        if expires_at <= time.time():
+            return None
+        return self.serializer.decode(data)
+
+    def _delete_session(self, store_id):
+        self.bus.publish("session_changed", store_id)
+
+        db = self.pool.acquire()
+        try:
+            db.execute("DELETE FROM sessions WHERE id = ?", (store_id,))
+            db.commit()
+        finally:
+            self.pool.release(db)
+
+    def _upsert_session(self, session_lifetime, session, store_id):
+        lifetime = session_lifetime.total_seconds()
+        data = self.serializer.encode(session)
+        now = time.time()
+
+        # Unchanged sessions with plenty of time left don't need a write
+        item = self.cache.get(store_id)
+        if item is not None and item[0] == data and item[1] - now > lifetime / 2:
+            return
+
+        expires_at = int(now + lifetime)
+        db = self.pool.acquire()
+        try:
+            db.execute("""
+                INSERT INTO sessions (id, data, expires_at) VALUES(?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at
+            """, (store_id, data, expires_at))
+            db.commit()
+        finally:
+            self.pool.release(db)
+
+        self.bus.publish("session_changed", store_id)
+        self.cache.set(store_id, (data, expires_at))
+
+    def _delete_expired_sessions(self):
+        db = self.pool.acquire()
+        try:
+            deleted = db.execute("DELETE FROM sessions WHERE expires_at <= ?", (int(time.time()),)).rowcount
+            db.commit()
+        finally:
+            self.pool.release(db)
+
+        self.deleted += deleted
+        return deleted
+
+    def stats(self):
+        """Return cache and cleanup counters"""
+
+        return dict(self.cache.stats(), expired_deleted_total=self.deleted)
@@ -1,11 +1,190 @@
 "use strict";
-let page = 1;
+let before = null;
 const pageSize = 20;
 let isEndOfMessages = false;
 let isOnLoadMessages = false;
+let isResuming = false;
+let pendingMessages = [];
+let savedIds = {};
+let unreadCounts = {};
+let markReadTimer = null;
 
-function resetRoom() {
-  socket.emit("reset_room");
+// Socket events arrive as positional arrays, fields in the order the server sends them
+const NEW_MESSAGE_FIELDS = ["channel_id", "name", "profile_url", "created_at", "message", "start_date_at", "id", "key"];
+const NEW_MEMBER_FIELDS = ["channel_id", "name", "profile_url", "member_count"];
+
+function decodeEvent(fields, values) {
+  const data = {};
+  fields.forEach((field, index) => {
+    data[field] = index < values.length ? values[index] : null;
+  });
+  return data;
+}
+
+function decodeNewMessage(values) {
+  return decodeEvent(NEW_MESSAGE_FIELDS, values);
+}
+
+function decodeNewMember(values) {
+  return decodeEvent(NEW_MEMBER_FIELDS, values);
+}
+
+function receiveMessages(batch) {
+  showNewMessages(batch.map(decodeNewMessage));
+}
+
+function showNewMessages(batch) {
+  // Hold live messages back until the missed ones are in
+  if (isResuming) {
+    pendingMessages = pendingMessages.concat(batch);
+    return;
+  }
+
+  // Render unseen messages of the open channel, scrolling once per batch
+  const chatMessages = document.querySelector("#message-list");
+  const lastId = lastMessageId();
+  const messages = batch.filter((message) => {
+    if (message.channel_id !== currentChannelId()) return false;
+
+    // Write-behind messages arrive before their id, they are told apart by key
+    if (message.key) {
+      if (message.id == null && message.key in savedIds) {
+        message.id = savedIds[message.key];
+        delete savedIds[message.key];
+      }
+      return !isMessageShown(chatMessages, message.key);
+    }
+
+    return message.id == null || message.id > lastId;
+  });
+
+  if (messages.length === 0) return;
+
+  if (chatMessages.innerHTML.includes("empty-messages")) {
+    chatMessages.innerHTML = "";
+  }
+
+  messages.forEach((message) => {
+    addNewMessage(message, chatMessages);
+    if (message.id > lastMessageId()) {
+      chatMessages.dataset.lastId = message.id;
+    }
+  });
+  chatMessages.scrollTop = chatMessages.scrollHeight;
+  scheduleMarkRead();
+}
+
+function isMessageShown(chatMessages, key) {
+  return chatMessages.querySelector(`li[data-key="${key}"]`) !== null;
+}
+
+function markMessagesSaved(channelId, ids) {
+  // Ids of messages shown before they were written, the read position follows them
+  if (channelId !== currentChannelId()) return;
+
+  const chatMessages = document.getElementById("message-list");
+  ids.forEach(([key, id]) => {
+    if (!isMessageShown(chatMessages, key)) {
+      // Still on its way, or held back while resuming
+      savedIds[key] = id;
+      return;
+    }
+
+    if (id > lastMessageId()) {
+      chatMessages.dataset.lastId = id;
+    }
+  });
+  scheduleMarkRead();
+}
+
+function scheduleMarkRead() {
+  // Move the read marker at most once a second while messages keep coming
+  if (markReadTimer) return;
+
+  markReadTimer = setTimeout(() => {
+    markReadTimer = null;
+    const channelId = currentChannelId();
+    const messageId = lastMessageId();
+    if (channelId && messageId) {
+      socket.emit("mark_read", { channel_id: channelId, message_id: messageId });
+    }
+  }, 1000);
+}
+
+function setUnreadCount(channelId, count) {
+  unreadCounts[channelId] = count;
+  showUnreadCounts();
+}
+
+function showUnreadCounts() {
+  // Channel lists are re-rendered by search and paging, badges follow the counts
+  document.querySelectorAll(".unread-count").forEach((badge) => {
+    const count = unreadCounts[badge.dataset.channelId] || 0;
+    badge.textContent = count > 99 ? "99+" : count;
+    badge.classList.toggle("hidden", count === 0);
+  });
+}
+
+function refreshUnreadCounts() {
+  if (!document.querySelector(".channel-list")) return;
+
+  fetch("/api/unread")
+    .then((response) => response.json())
+    .then((data) => {
+      unreadCounts = {};
+      data.items.forEach((item) => {
+        unreadCounts[item.channel_id] = item.unread;
+      });
+      showUnreadCounts();
+    });
+}
+
+function lastMessageId() {
+  const chatMessages = document.getElementById("message-list");
+  return Number((chatMessages && chatMessages.dataset.lastId) || 0);
+}
+
+function currentChannelId() {
+  const chatMessages = document.getElementById("message-list");
+  if (!chatMessages || !chatMessages.dataset.channelId) return null;
+
+  return Number(chatMessages.dataset.channelId);
+}
+
+function resetRoom(channelId) {
+  channelId = channelId || currentChannelId();
+  if (channelId) {
+    socket.emit("reset_room", channelId);
+  }
+}
+
+function resumeRoom() {
+  // Follow the open channel again and catch up on what was sent while offline
+  const channelId = currentChannelId();
+  if (!channelId) return;
+
+  isResuming = true;
+  socket.emit("resume", { channel_id: channelId, after: lastMessageId() }, (result) => {
+    const pending = pendingMessages;
+    isResuming = false;
+    pendingMessages = [];
+
+    if (result && result.gap) {
+      // Too much was missed, start over from the latest page
+      const chatMessages = document.getElementById("message-list");
+      chatMessages.innerHTML = `<li id="empty-messages" class="flex justify-center items-center h-full"><p class="text-lg text-slate-300">No messages yet</p></li>`;
+      chatMessages.dataset.lastId = 0;
+      savedIds = {};
+      before = result.items.length > 0 ? result.items[0].id : null;
+      isEndOfMessages = !before;
+    }
+
+    const missed = result ? result.items : [];
+    missed.forEach((message) => {
+      message.channel_id = channelId;
+    });
+    showNewMessages(missed.concat(pending));
+  });
 }
 
 function autoRemoveToast() {
@@ -37,6 +216,10 @@ function listenMoreMessages() {
   const chatMessages = document.getElementById("message-list");
   if (!chatMessages) return;
 
+  // Cursor of the oldest rendered message
+  before = chatMessages.dataset.before || null;
+  if (!before) isEndOfMessages = true;
+
   chatMessages.addEventListener("scroll", () => {
     if (
       Math.abs(
@@ -47,7 +230,6 @@ function listenMoreMessages() {
     ) {
       if (isEndOfMessages || isOnLoadMessages) return;
 
-      page += 1;
       isOnLoadMessages = true;
 
       // Add loading indicator
@@ -58,7 +240,8 @@ function listenMoreMessages() {
       chatMessages.appendChild(loadingLi);
 
       // Fetch more messages
-      fetch(`/messages?page=${page}&pageSize=${pageSize}`)
+      const channelId = chatMessages.dataset.channelId;
+      fetch(`/api/channels/${channelId}/messages?before=${before}&limit=${pageSize}`)
         .then((response) => response.json())
         .then((data) => {
           const chatMessages = document.querySelector("#message-list");
@@ -85,12 +268,93 @@ function listenMoreMessages() {
             addNewMessage(message, chatMessages, false);
           });
 
+          before = data.next_before;
+          if (!before) isEndOfMessages = true;
+
           isOnLoadMessages = false;
         });
     }
   });
 }
 
+function loadMoreMembers() {
+  const memberLists = document.querySelectorAll(".member-list");
+  if (memberLists.length === 0) return;
+
+  const { channelId, before } = memberLists[0].dataset;
+  if (!before) return;
+
+  fetch(`/channel/${channelId}/members?before=${before}`)
+    .then((response) => response.json())
+    .then((data) => {
+      memberLists.forEach((list) => {
+        const more = list.querySelector(".member-more");
+
+        data.items.forEach((member) => {
+          list.insertBefore(createMemberItem(member), more);
+        });
+
+        if (data.next_before) {
+          list.dataset.before = data.next_before;
+        } else {
+          delete list.dataset.before;
+          if (more) more.remove();
+        }
+      });
+    });
+}
+
+function openChannel(channelId) {
+  fetch(`/api/channels/${channelId}`)
+    .then((response) => response.json())
+    .then((data) => {
+      const { channel, messages } = data;
+
+      // Header links to the channel details
+      const title = document.getElementById("channel-title");
+      title.classList.remove("hidden");
+      const link = document.createElement("a");
+      link.href = `/channel/${channel.id}`;
+      link.textContent = channel.name;
+      title.replaceChildren(link);
+
+      // Replace the message list and its paging cursor
+      const chatMessages = document.getElementById("message-list");
+      chatMessages.innerHTML = "";
+      chatMessages.dataset.channelId = channel.id;
+      chatMessages.dataset.lastId = messages.items.length > 0 ? messages.items[0].id : 0;
+      savedIds = {};
+
+      if (messages.items.length === 0) {
+        chatMessages.innerHTML = `<li id="empty-messages" class="flex justify-center items-center h-full"><p class="text-lg text-slate-300">No messages yet</p></li>`;
+      }
+
+      messages.items.forEach((message) => {
+        addNewMessage(message, chatMessages, false);
+      });
+
+      before = messages.next_before;
+      isEndOfMessages = !before;
+      isOnLoadMessages = false;
+
+      resetRoom(channel.id);
+      setUnreadCount(channel.id, 0);
+    });
+}
+
+function listenChannelLinks() {
+  // Switch channels in place on the home page instead of loading a new page
+  document.querySelectorAll(".channel-list").forEach((list) => {
+    list.addEventListener("click", (event) => {
+      const link = event.target.closest("a[data-channel-id]");
+      if (!link || event.ctrlKey || event.metaKey || event.shiftKey) return;
+
+      event.preventDefault();
+      openChannel(link.dataset.channelId);
+    });
+  });
+}
+
 function goBack() {
   window.history.back();
 }
@@ -101,13 +365,19 @@ function submitMessage(event) {
   const formData = new FormData(form);
   const message = formData.get("message");
 
-  socket.emit("new_message", message);
+  socket.emit("new_message", { channel_id: currentChannelId(), message }, (response) => {
+    // The server dropped the message, give it back to send again
+    if (response && response.error) {
+      if (!form.elements.message.value) form.elements.message.value = message;
+      showErrorToast(response.error);
+    }
+  });
   form.reset();
 }
 
 window.onload = function () {
-  resetRoom();
   autoRemoveToast();
   animateSubmitButton();
   listenMoreMessages();
+  listenChannelLinks();
 };
@@ -2,33 +2,56 @@
 const socket = io();
 const exeptionalPages = ["apology", "profile", "password", "register", "login"];
 
+// Names and messages are user input, nodes are built with textContent so none of it is parsed as HTML
+function createElement(tag, className, text) {
+  const element = document.createElement(tag);
+  element.className = className;
+  if (text != null) element.textContent = text;
+  return element;
+}
+
+function createPicture(url, imageClass, placeholderClass) {
+  if (url) {
+    const image = createElement("img", imageClass);
+    image.src = url;
+    image.alt = "Profile Picture";
+    return image;
+  }
+
+  const placeholder = createElement("div", placeholderClass);
+  const icon = createElement("i", "fa-solid fa-user");
+  icon.style.color = "black";
+  placeholder.appendChild(icon);
+  return placeholder;
+}
+
 const addNewMessage = (message, container, isNew = true) => {
-  const newDivider = document.createElement("li");
-  newDivider.className = "flex justify-center items-center";
-  newDivider.innerHTML = `
-      <hr class="w-full border border-slate-500" />
-      <p class="text-xs font-semibold text-slate-300 shrink-0 px-3">${message.start_date_at}</p>
-      <hr class="w-full border border-slate-500" />
-      `;
-
-  const newMessage = document.createElement("li");
-  newMessage.className = "flex gap-4";
-  newMessage.innerHTML = `
-      ${
-        message.profile_url
-          ? `<img src="${message.profile_url}" alt="Profile Picture" class="w-9 h-9 rounded-lg shrink-0 object-cover">`
-          : `<div class="w-9 h-9 bg-slate-300 rounded-lg flex items-center justify-center shrink-0"><i class="fa-solid fa-user" style="color: black"></i></div>`
-      }
-      <div class="flex flex-col gap-1">
-        <div class="flex items-center gap-3">
-          <span class="font-semibold text-lg text-slate-300">${
-            message.name
-          }</span>
-          <span class="text-slate-400 text-sm">${message.created_at}</span>
-        </div>
-        <p class="text-lg text-gray-100">${message.message}</p>
-      </div>
-      `;
+  const newDivider = createElement("li", "flex justify-center items-center");
+  newDivider.append(
+    createElement("hr", "w-full border border-slate-500"),
+    createElement("p", "text-xs font-semibold text-slate-300 shrink-0 px-3", message.start_date_at),
+    createElement("hr", "w-full border border-slate-500")
+  );
+
+  const heading = createElement("div", "flex items-center gap-3");
+  heading.append(
+    createElement("span", "font-semibold text-lg text-slate-300", message.name),
+    createElement("span", "text-slate-400 text-sm", message.created_at)
+  );
+
+  const content = createElement("div", "flex flex-col gap-1");
+  content.append(heading, createElement("p", "text-lg text-gray-100 break-words", message.message));
+
+  const newMessage = createElement("li", "flex gap-4");
+  if (message.key) newMessage.dataset.key = message.key;
+  newMessage.append(
+    createPicture(
+      message.profile_url,
+      "w-9 h-9 rounded-lg shrink-0 object-cover",
+      "w-9 h-9 bg-slate-300 rounded-lg flex items-center justify-center shrink-0"
+    ),
+    content
+  );
 
   if (isNew) {
     if (message.start_date_at) {
@@ -48,6 +71,10 @@ const addNewMessage = (message, container, isNew = true) => {
 };
 
 socket.on("connect", function () {
+  // Connection state lives on the server, follow the open channel again after
+  // reconnecting and fetch only the messages missed meanwhile
+  resumeRoom();
+
   const body = document.querySelector("body");
   const newToast = document.createElement("div");
   newToast.id = "toast-default";
@@ -62,43 +89,104 @@ socket.on("connect", function () {
 });
 
 socket.on("disconnect", function () {
+  showErrorToast("You are offline!");
+});
+
+function showErrorToast(text) {
   const body = document.querySelector("body");
   const newToast = document.createElement("div");
   newToast.id = "toast-default";
   newToast.className =
     "fixed border border-red-800 flex items-center w-full max-w-xs p-4 text-gray-300 bg-slate-800 rounded-lg shadow top-5 right-5 gap-2";
   newToast.role = "alert";
-  newToast.innerHTML = `<div class="inline-flex items-center justify-center flex-shrink-0 w-8 h-8 text-red-500 bg-red-100 rounded-lg dark:bg-red-800 dark:text-red-200"><svg class="w-5 h-5" aria-hidden="true" xmlns="http://www.w3.org/2000/svg" fill="currentColor" viewBox="0 0 20 20"><path d="M10 .5a9.5 9.5 0 1 0 9.5 9.5A9.51 9.51 0 0 0 10 .5Zm3.707 11.793a1 1 0 1 1-1.414 1.414L10 11.414l-2.293 2.293a1 1 0 0 1-1.414-1.414L8.586 10 6.293 7.707a1 1 0 0 1 1.414-1.414L10 8.586l2.293-2.293a1 1 0 0 1 1.414 1.414L11.414 10l2.293 2.293Z"/></svg><span class="sr-only">Error icon</span></div><div class="ms-2 text-sm font-normal break-words">You are offline!</div><button type="button" class="ms-auto -mx-1.5 -my-1.5 rounded-lg focus:ring-2 focus:ring-gray-300 p-1.5 inline-flex items-center justify-center h-8 w-8 text-gray-500 hover:text-white bg-gray-800 hover:bg-gray-700" data-dismiss-target="#toast-default" aria-label="Close"><span class="sr-only">Close</span><svg class="w-3 h-3" aria-hidden="true" xmlns="http://www.w3.org/2000/svg" fill="none" viewBox="0 0 14 14"><path stroke="currentColor" stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="m1 1 6 6m0 0 6 6M7 7l6-6M7 7l-6 6"/></svg></button>`;
+  newToast.innerHTML = `<div class="inline-flex items-center justify-center flex-shrink-0 w-8 h-8 text-red-500 bg-red-100 rounded-lg dark:bg-red-800 dark:text-red-200"><svg class="w-5 h-5" aria-hidden="true" xmlns="http://www.w3.org/2000/svg" fill="currentColor" viewBox="0 0 20 20"><path d="M10 .5a9.5 9.5 0 1 0 9.5 9.5A9.51 9.51 0 0 0 10 .5Zm3.707 11.793a1 1 0 1 1-1.414 1.414L10 11.414l-2.293 2.293a1 1 0 0 1-1.414-1.414L8.586 10 6.293 7.707a1 1 0 0 1 1.414-1.414L10 8.586l2.293-2.293a1 1 0 0 1 1.414 1.414L11.414 10l2.293 2.293Z"/></svg><span class="sr-only">Error icon</span></div><div class="toast-text ms-2 text-sm font-normal break-words"></div><button type="button" class="ms-auto -mx-1.5 -my-1.5 rounded-lg focus:ring-2 focus:ring-gray-300 p-1.5 inline-flex items-center justify-center h-8 w-8 text-gray-500 hover:text-white bg-gray-800 hover:bg-gray-700" data-dismiss-target="#toast-default" aria-label="Close"><span class="sr-only">Close</span><svg class="w-3 h-3" aria-hidden="true" xmlns="http://www.w3.org/2000/svg" fill="none" viewBox="0 0 14 14"><path stroke="currentColor" stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="m1 1 6 6m0 0 6 6M7 7l6-6M7 7l-6 6"/></svg></button>`;
+  newToast.querySelector(".toast-text").textContent = text;
 
   if (!exeptionalPages.some((page) => window.location.href.includes(page))) {
     body.appendChild(newToast);
   }
+}
+
+socket.on("new_message", function (values) {
+  receiveMessages([values]);
+});
+
+socket.on("messages_batch", function (batch) {
+  receiveMessages(batch);
 });
 
-socket.on("new_message", function (json) {
-  const message = JSON.parse(json);
-  const chatMessages = document.querySelector("#message-list");
+socket.on("messages_saved", function ([channelId, ids]) {
+  markMessagesSaved(channelId, ids);
+});
 
-  if (chatMessages.innerHTML.includes("empty-messages")) {
-    chatMessages.innerHTML = "";
-  }
+// Unread counts may have changed while offline, the page rendered them on load
+socket.io.on("reconnect", function () {
+  refreshUnreadCounts();
+});
 
-  addNewMessage(message, chatMessages);
-  chatMessages.scrollTop = chatMessages.scrollHeight;
+// The server dropped events this page was too slow to take, catch up like after a reconnect
+socket.on("resync", function () {
+  resumeRoom();
+  refreshUnreadCounts();
 });
 
-socket.on("new_member", function (json) {
-  const member = JSON.parse(json);
+socket.on("channel_activity", function ([channelId, lastId, count]) {
+  // The open channel is read as messages arrive
+  if (channelId === currentChannelId()) return;
+
+  setUnreadCount(channelId, (unreadCounts[channelId] || 0) + count);
+});
+
+socket.on("channel_read", function ([channelId, messageId]) {
+  setUnreadCount(channelId, 0);
+});
+
+function createMemberItem(member) {
+  const newLi = createElement("li", "flex items-center text-slate-200");
+  newLi.append(
+    createPicture(
+      member.profile_url,
+      "w-9 h-9 rounded object-cover shrink-0",
+      "w-9 h-9 bg-slate-300 rounded flex items-center justify-center"
+    ),
+    createElement("span", "ml-3 font-semibold text-lg", member.name)
+  );
+  return newLi;
+}
+
+socket.on("new_member", function (values) {
+  const member = decodeNewMember(values);
+
+  if (member.channel_id !== currentChannelId()) return;
+
   const memberList = document.querySelectorAll(".member-list");
-  const newLi = document.createElement("li");
-  newLi.className = "flex items-center text-slate-200";
-  newLi.innerHTML = `${
-    member.profile_url
-      ? ` <img src="${member.profile_url}" alt="Profile Picture" class="w-9 h-9 rounded object-cover shrink-0">`
-      : `<div class="w-9 h-9 bg-slate-300 rounded flex items-center justify-center"><i class="fa-solid fa-user" style="color: black"></i></div>`
-  }<span class="ml-3 font-semibold text-lg">${member.name}</span>`;
+  const memberCount = document.querySelectorAll(".member-count");
 
   memberList.forEach((list) => {
-    list.insertBefore(newLi, list.firstChild);
+    list.insertBefore(createMemberItem(member), list.firstChild);
+  });
+
+  memberCount.forEach((count) => {
+    count.textContent = member.member_count;
+  });
+});
+
+socket.on("profile_updated", function (data) {
+  // Swap every picture of the current user, placeholders become images
+  document.querySelectorAll(".user-picture").forEach((picture) => {
+    if (picture.tagName === "IMG") {
+      picture.src = data.profile_url;
+      return;
+    }
+
+    const image = document.createElement("img");
+    image.src = data.profile_url;
+    image.alt = "Profile Picture";
+    image.className = picture.className
+      .split(" ")
+      .filter((name) => /^(user-picture|w-|h-|rounded)/.test(name))
+      .concat(["object-cover", "shrink-0"])
+      .join(" ");
+    picture.replaceWith(image);
   });
 });
@@ -0,0 +1,37 @@
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.seed import PASSWORD
+from tests.worker import WorkerTestCase
+
+LOGINS = 12
+
+
+class LoginStormTest(WorkerTestCase):
+    """Logins queue for the password hasher without holding database connections"""
+
+    users = LOGINS + 1
+    environ = {
+        "DATABASE_POOL_SIZE": "2",
+        "DATABASE_POOL_TIMEOUT": "0.5",
+        "PASSWORD_HASH_CONCURRENCY": "1",
+    }
+
+    def test_pages_load_during_a_login_storm(self):
+        reader = self.client()
+        reader.login("bench%d" % LOGINS, PASSWORD)
+
+        with ThreadPoolExecutor(LOGINS) as executor:
+            logins = executor.map(self.login, range(LOGINS))
+
+            # Every login waits for the single hasher slot meanwhile
+            time.sleep(0.2)
+            status, _, _ = reader.request("GET", "/api/unread")
+            self.assertEqual(status, 200)
+
+            self.assertEqual(list(logins), [302] * LOGINS)
+
+
+if __name__ == "__main__":
+    unittest.main()
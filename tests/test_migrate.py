@@ -0,0 +1,46 @@
+import os
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from io import StringIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from migrate import check_query_plans, full_scans
+
+
+class QueryPlanCheckTest(unittest.TestCase):
+    def check(self, source):
+        with tempfile.NamedTemporaryFile("w", suffix=".py") as module:
+            module.write(source)
+            module.flush()
+            output = StringIO()
+            with redirect_stdout(output):
+                failures = check_query_plans([module.name])
+        return failures, output.getvalue()
+
+    def test_unindexed_query_fails(self):
+        failures, output = self.check('db.execute("SELECT id FROM messages WHERE message = ?", (text,))\n')
+        self.assertEqual(failures, 1)
+        self.assertIn(":1: SCAN messages", output)
+
+    def test_indexed_query_passes(self):
+        failures, _ = self.check('db.execute("SELECT id FROM messages WHERE channel_id = ? ORDER BY id DESC LIMIT 20", (channel_id,))\n')
+        self.assertEqual(failures, 0)
+
+    def test_both_sqlite_plan_formats(self):
+        plan = [
+            (2, 0, 0, "SCAN messages"),
+            (3, 0, 0, "SCAN TABLE users"),
+            (4, 0, 0, "SCAN TABLE members USING INDEX members_channel_id"),
+            (5, 0, 0, "SCAN sqlite_master"),
+            (6, 0, 0, "SCAN TABLE sqlite_master"),
+            (7, 0, 0, "SEARCH messages USING INDEX messages_channel_id (channel_id=?)"),
+        ]
+        self.assertEqual(full_scans(plan), ["SCAN messages", "SCAN TABLE users"])
+
+
+if __name__ == "__main__":
+    unittest.main()
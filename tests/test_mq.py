@@ -0,0 +1,78 @@
+import os
+import pickle
+import socket
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from mq import UnixSocketManager, private_directory
+from wire import NewMessage
+
+
+class PrivateDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_creates_missing_directory(self):
+        path = private_directory(os.path.join(self.tmp.name, "mq"))
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o700)
+
+    def test_refuses_directory_others_can_write(self):
+        path = os.path.join(self.tmp.name, "mq")
+        os.mkdir(path)
+        os.chmod(path, 0o777)
+        with self.assertRaises(RuntimeError):
+            private_directory(path)
+
+    def test_refuses_symlink(self):
+        target = private_directory(os.path.join(self.tmp.name, "target"))
+        link = os.path.join(self.tmp.name, "mq")
+        os.symlink(target, link)
+        with self.assertRaises(RuntimeError):
+            private_directory(link)
+
+    @unittest.skipUnless(os.getuid() == 0, "changing the owner needs root")
+    def test_refuses_directory_of_another_user(self):
+        path = os.path.join(self.tmp.name, "mq")
+        os.mkdir(path, 0o700)
+        os.chown(path, 65534, 65534)
+        with self.assertRaises(RuntimeError):
+            private_directory(path)
+
+
+class UnixSocketManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        url = "unix://" + os.path.join(self.tmp.name, "mq")
+
+        self.sender = UnixSocketManager(url, write_only=True)
+        self.receiver = UnixSocketManager(url)
+        self.receiver.server = mock.Mock()
+        self.receiver.initialize()
+        self.addCleanup(self.sender.close)
+        self.addCleanup(self.receiver.close)
+
+    def test_round_trip(self):
+        message = {"method": "emit", "event": "new_message", "data": NewMessage(1, "Ann", None, "today", "hi", None, 7), "room": 1, "host_id": "a"}
+        self.sender._publish(message)
+        self.assertEqual(next(self.receiver._listen()), dict(message, data=[1, "Ann", None, "today", "hi", None, 7, None]))
+
+        self.sender._publish(dict(message, data=("one", 2)))
+        self.assertEqual(next(self.receiver._listen())["data"], ("one", 2))
+
+    def test_pickles_are_dropped(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(pickle.dumps({"method": "bus"}), self.receiver.path)
+        self.sender._publish({"method": "bus", "topic": "user_updated", "payload": 3, "host_id": "a"})
+
+        self.assertEqual(next(self.receiver._listen())["payload"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,28 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from tests.worker import WorkerTestCase
+
+POOL_SIZE = 2
+LOGINS = 8
+
+
+class ConcurrentLoginTest(WorkerTestCase):
+    """Sessions are saved while each request still holds its database connection"""
+
+    users = LOGINS
+    environ = {
+        "DATABASE_POOL_SIZE": str(POOL_SIZE),
+        "DATABASE_POOL_TIMEOUT": "5",
+        "PASSWORD_HASH_CONCURRENCY": str(LOGINS),
+    }
+
+    def test_more_concurrent_logins_than_pool_connections(self):
+        with ThreadPoolExecutor(LOGINS) as executor:
+            statuses = list(executor.map(self.login, range(LOGINS)))
+
+        self.assertEqual(statuses, [302] * LOGINS)
+
+
+if __name__ == "__main__":
+    unittest.main()
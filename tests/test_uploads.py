@@ -0,0 +1,79 @@
+import io
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import uploads
+from uploads import LocalStorage, UploadPipeline, can_resize, resize_image
+
+
+class Upload:
+    """Stands in for werkzeug's FileStorage"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(self.data)
+
+
+def png(width, height):
+    output = io.BytesIO()
+    uploads.Image.new("RGB", (width, height), "red").save(output, format="PNG")
+    return output.getvalue()
+
+
+@unittest.skipUnless(can_resize(), "Pillow is not installed")
+class ResizeImageTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        self.path = os.path.join(self.workdir.name, "picture.png")
+
+    def size_after_resize(self, width, height):
+        Upload(png(width, height)).save(self.path)
+        resize_image(self.path, 256)
+        with uploads.Image.open(self.path) as image:
+            return image.size, image.format
+
+    def test_large_image_shrinks_to_fit(self):
+        self.assertEqual(self.size_after_resize(1024, 512), ((256, 128), "PNG"))
+
+    def test_small_image_is_kept(self):
+        self.assertEqual(self.size_after_resize(100, 50), ((100, 50), "PNG"))
+
+    def test_pipeline_stores_resized_image(self):
+        storage = LocalStorage(os.path.join(self.workdir.name, "uploads"), "/static/uploads/")
+        done = []
+        pipeline = UploadPipeline(storage, lambda key, url: done.append((key, url)), os.path.join(self.workdir.name, "spool"), size=64, workers=1)
+        pipeline.start()
+        pipeline.submit("user-1", Upload(png(640, 640)), "png")
+        pipeline.join()
+
+        self.assertEqual(pipeline.failed, 0)
+        self.assertEqual(done[0][0], "user-1")
+        self.assertTrue(done[0][1].startswith("/static/uploads/user-1.png?v="))
+        with uploads.Image.open(os.path.join(storage.directory, "user-1.png")) as image:
+            self.assertEqual(image.size, (64, 64))
+
+
+class WithoutPillowTest(unittest.TestCase):
+    def test_resize_leaves_image_alone(self):
+        with tempfile.NamedTemporaryFile(suffix=".png") as f:
+            f.write(b"not resized")
+            f.flush()
+            with mock.patch.object(uploads, "Image", None):
+                self.assertFalse(can_resize())
+                self.assertEqual(resize_image(f.name, 256), f.name)
+            with open(f.name, "rb") as image:
+                self.assertEqual(image.read(), b"not resized")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.client import HTTPClient
+from benchmarks.fanout import HOST, serve, wait_for_port
+from benchmarks.seed import PASSWORD, seed
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+class WorkerTestCase(unittest.TestCase):
+    """Run one app worker on a seeded database, configured by `environ`"""
+
+    users = 10
+    environ = {}
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        database = os.path.join(self.workdir.name, "chat.db")
+        seed(database, users=self.users, channels=1, messages=0)
+
+        environ = mock.patch.dict(os.environ, dict({"DATABASE": database, "SESSION_TYPE": "sqlite", "TIMEZONE": "UTC"}, **self.environ))
+        environ.start()
+        self.addCleanup(environ.stop)
+
+        self.port = free_port()
+        self.worker = multiprocessing.Process(target=serve, args=(self.workdir.name, self.port), daemon=True)
+        self.worker.start()
+        self.addCleanup(self.worker.join)
+        self.addCleanup(self.worker.terminate)
+        wait_for_port(self.port)
+
+    def client(self):
+        return HTTPClient(HOST, self.port)
+
+    def login(self, index):
+        """Log user bench<index> in, return the response status"""
+
+        status, _, _ = self.client().request("POST", "/login", {"username": "bench%d" % index, "password": PASSWORD})
+        return status
@@ -0,0 +1,138 @@
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+
+import cloudinary.uploader
+from eventlet import tpool
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+
+class LocalStorage:
+    """Store files in a local directory served under `base_url`, for development and tests"""
+
+    def __init__(self, directory, base_url):
+        self.directory = directory
+        self.base_url = base_url
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, path, key):
+        """Copy the file at `path` under `key` and return its URL"""
+
+        filename = "%s%s" % (key, os.path.splitext(path)[1])
+        shutil.copyfile(path, os.path.join(self.directory, filename))
+
+        # Cache-busting version, the file name is reused on every upload
+        return "%s%s?v=%d" % (self.base_url, filename, time.time())
+
+
+class CloudinaryStorage:
+    """Store files in a Cloudinary folder"""
+
+    def __init__(self, folder, size=None):
+        self.folder = folder
+        self.size = size
+
+    def save(self, path, key):
+        options = {"folder": self.folder, "public_id": key, "overwrite": True}
+        if self.size:
+            options["transformation"] = {"width": self.size, "height": self.size, "crop": "fill"}
+        return cloudinary.uploader.upload(path, **options)["url"]
+
+
+def can_resize():
+    """Whether Pillow is installed, without it images are stored at their original size"""
+
+    return Image is not None
+
+
+def resize_image(path, size):
+    """Shrink an image to fit `size` pixels in place, when Pillow is installed"""
+
+    if Image is None:
+        return path
+
+    with Image.open(path) as image:
+        if image.width <= size and image.height <= size:
+            return path
+        image.thumbnail((size, size))
+        image.save(path, format=image.format)
+    return path
+
+
+class UploadPipeline:
+    """Process and store uploaded images in the background.
+
+    `submit` only spools the upload to `spool_dir` and queues it, so requests
+    return right away. `workers` green threads then resize each image in
+    eventlet's OS thread pool, since that's CPU-bound, save it to `storage` and
+    call `on_done(key, url)`. The queue is bounded; `submit` raises
+    `queue.Full` when it is.
+    """
+
+    def __init__(self, storage, on_done, spool_dir, size=256, workers=2, max_queue=100):
+        self.storage = storage
+        self.on_done = on_done
+        self.spool_dir = spool_dir
+        self.size = size
+        self.workers = workers
+        self._queue = queue.Queue(max_queue)
+        self._threads = []
+        self.completed = 0
+        self.failed = 0
+        os.makedirs(spool_dir, exist_ok=True)
+
+    def start(self):
+        """Start the background workers"""
+
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._run, name="upload-%d" % len(self._threads), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, file, extension):
+        """Stream an uploaded file to the spool directory and queue it for processing"""
+
+        path = os.path.join(self.spool_dir, "%s.%s" % (uuid.uuid4().hex, extension))
+        file.save(path)
+
+        try:
+            self._queue.put_nowait((key, path))
+        except queue.Full:
+            os.remove(path)
+            raise
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            key, path = self._queue.get()
+            try:
+                tpool.execute(resize_image, path, self.size)
+                url = self.storage.save(path, key)
+                self.on_done(key, url)
+                self.completed += 1
+            except Exception:
+                self.failed += 1
+                logger.exception("Upload of %s failed", key)
+            finally:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                self._queue.task_done()
+
+    def join(self):
+        """Wait until every queued upload was processed"""
+
+        self._queue.join()
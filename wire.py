@@ -0,0 +1,55 @@
+from typing import Optional
+
+import msgspec
+
+
+class NewMessage(msgspec.Struct, array_like=True):
+    """A chat line broadcast to a channel room, sent as a positional array.
+
+    Write-behind messages go out before they have an id, with a `key` that
+    the `messages_saved` event later pairs with the id.
+    """
+
+    channel_id: int
+    name: str
+    profile_url: Optional[str]
+    created_at: str
+    message: str
+    start_date_at: Optional[str] = None
+    id: Optional[int] = None
+    key: Optional[str] = None
+
+
+class NewMember(msgspec.Struct, array_like=True):
+    """A user joining a channel, sent as a positional array"""
+
+    channel_id: int
+    name: str
+    profile_url: Optional[str]
+    member_count: int
+
+
+_encoder = msgspec.json.Encoder()
+_decoder = msgspec.json.Decoder()
+
+
+class WireJSON:
+    """JSON module for Socket.IO packets backed by msgspec.
+
+    Structs above are written straight into the packet, so each broadcast is
+    encoded once into a compact array instead of a JSON string nested inside
+    the Socket.IO envelope. Accepts and ignores the stdlib keyword arguments and
+    raises ValueError on malformed input like the stdlib does.
+    """
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return _encoder.encode(obj).decode()
+
+    @staticmethod
+    def loads(s, **kwargs):
+        # Engine.IO tells JSON from plain text packets by catching ValueError
+        try:
+            return _decoder.decode(s)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
@@ -0,0 +1,129 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """Persist chat messages in batches from a background green thread.
+
+    Messages are queued by the socket handler as they are broadcast and
+    written every `interval` seconds or `batch_size` messages, whichever comes
+    first, in a single transaction. The queue is bounded: when the database falls
+    behind, `put` blocks the sender for up to `put_timeout` seconds before
+    raising `queue.Full`.
+
+    After each commit `on_written` is called with a list of (message id, data)
+    pairs, `data` being whatever was passed to `put` with the row.
+    """
+
+    def __init__(self, pool, interval=0.05, batch_size=200, max_queue=10000, put_timeout=5, on_written=None):
+        self.pool = pool
+        self.on_written = on_written
+        self.interval = interval
+        self.batch_size = batch_size
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(max_queue)
+        self._thread = None
+        self._running = False
+        self.written = 0
+        self.batches = 0
+
+    def start(self):
+        """Start the background writer"""
+
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+            self._thread.start()
+
+    def put(self, channel_id, user_id, message, is_start_date, created_at, data=None):
+        """Queue a message row, waiting for room when the queue is full"""
+
+        self._queue.put(((channel_id, user_id, message, is_start_date, created_at), data), timeout=self.put_timeout)
+
+    def pending(self):
+        """Return the number of messages waiting to be written"""
+
+        return self._queue.qsize()
+
+    def _take_batch(self, wait):
+        """Collect up to batch_size rows, waiting at most `wait` seconds for the first one"""
+
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=wait))
+        except queue.Empty:
+            return batch
+
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        """Insert a batch of rows in one transaction"""
+
+        db = self.pool.acquire()
+        try:
+            db.executemany("INSERT INTO messages (channel_id, user_id, message, is_start_date, created_at) VALUES(?, ?, ?, ?, ?)", [row for row, _ in batch])
+
+            # The transaction holds the write lock, so the batch got consecutive ids
+            last_id = db.execute("SELECT last_insert_rowid()").fetchone()[0]
+            db.commit()
+        finally:
+            self.pool.release(db)
+
+        self.written += len(batch)
+        self.batches += 1
+
+        if self.on_written:
+            first_id = last_id - len(batch) + 1
+            try:
+                self.on_written([(first_id + index, data) for index, (_, data) in enumerate(batch)])
+            except Exception:
+                # The rows are committed, never retry the batch because of a callback
+                logger.exception("Handling %d written messages failed", len(batch))
+
+    def _run(self):
+        batch = []
+        while self._running or batch:
+            if not batch:
+                batch = self._take_batch(self.interval)
+            if not batch:
+                continue
+
+            try:
+                self._write(batch)
+                batch = []
+            except Exception:
+                # Keep the batch and retry, the queue applies backpressure meanwhile
+                logger.exception("Failed to write %d messages, retrying", len(batch))
+                time.sleep(self.interval)
+
+    def flush(self):
+        """Stop the background writer and synchronously write everything still queued"""
+
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(self.put_timeout)
+            self._thread = None
+
+        while True:
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                break
+            self._write(batch)